@@ -0,0 +1,152 @@
+import argparse
+import copy
+import os
+import sys
+import tempfile
+import time
+
+from key_path import KeyPath
+from merge_yamls import YamlMerger
+
+
+def recursive_merge_yaml(
+    merger, base, target, path=None, changes=None, visited=None, state=None
+):
+    # The recursive merge_yaml this benchmark compares against.
+    if changes is None:
+        changes = []
+    if state is None:
+        state = merger.skip_rules.root
+    if visited is None:
+        visited = set()
+    pair = (id(base), id(target))
+    if pair in visited:
+        return changes
+    visited.add(pair)
+    for key in base:
+        key_state = merger.skip_rules.step(state, key)
+        if key_state.skipped:
+            continue
+        current_path = KeyPath(path, key)
+        if key not in target:
+            target[key] = base[key]
+            changes.append({"path": current_path, "type": "added", "new": base[key]})
+        elif isinstance(base[key], dict) and isinstance(target[key], dict):
+            recursive_merge_yaml(
+                merger,
+                base[key],
+                target[key],
+                current_path,
+                changes,
+                visited,
+                key_state,
+            )
+        elif base[key] != target[key]:
+            old_value = target[key]
+            target[key] = base[key]
+            changes.append(
+                {
+                    "path": current_path,
+                    "type": "updated",
+                    "old": old_value,
+                    "new": base[key],
+                }
+            )
+    return changes
+
+
+def deep_documents(depth, fanout):
+    # Chains of nested mappings `depth` levels deep, `fanout` of them side by
+    # side, with a leaf change every other level.
+    base, target = {}, {}
+    for branch in range(fanout):
+        base_node = base.setdefault(f"branch{branch}", {})
+        target_node = target.setdefault(f"branch{branch}", {})
+        for level in range(depth):
+            base_node["value"] = level
+            target_node["value"] = level if level % 2 else -level
+            base_node = base_node.setdefault("child", {})
+            target_node = target_node.setdefault("child", {})
+    return base, target
+
+
+def wide_documents(width):
+    # One mapping of `width` services with a few scalar keys each; every
+    # tenth service differs and every hundredth is missing from the target.
+    base, target = {}, {}
+    for i in range(width // 4):
+        service = {"port": i, "replicas": 2, "name": f"svc{i}", "enabled": True}
+        base[f"svc{i}"] = service
+        if i % 100:
+            target[f"svc{i}"] = dict(service, port=i + (i % 10 == 0))
+    return base, target
+
+
+def rendered(changes):
+    return [dict(change, path=str(change["path"])) for change in changes]
+
+
+def best_time(func, documents, repeat):
+    best = None
+    changes = None
+    for _ in range(repeat):
+        base, target = copy.deepcopy(documents)
+        start = time.perf_counter()
+        changes = func(base, target)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, changes
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the iterative merge_yaml against the recursive one."
+    )
+    parser.add_argument("--depth", type=int, default=60)
+    parser.add_argument("--fanout", type=int, default=200)
+    parser.add_argument("--width", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        merger = YamlMerger(os.devnull, os.devnull)
+        cases = [
+            (
+                f"deep (depth {args.depth} x {args.fanout})",
+                deep_documents(args.depth, args.fanout),
+            ),
+            (f"wide ({args.width} keys)", wide_documents(args.width)),
+        ]
+        for name, documents in cases:
+            recursive_time, recursive_changes = best_time(
+                lambda b, t: recursive_merge_yaml(merger, b, t), documents, args.repeat
+            )
+            iterative_time, iterative_changes = best_time(
+                merger.merge_yaml, documents, args.repeat
+            )
+            overlay_time, overlay_changes = best_time(
+                lambda b, t: merger.merge_overlay(b, t)[1], documents, args.repeat
+            )
+            if rendered(iterative_changes) != rendered(recursive_changes):
+                sys.exit(f"{name}: change lists differ")
+            if rendered(overlay_changes) != rendered(recursive_changes):
+                sys.exit(f"{name}: copy-on-write change list differs")
+            print(
+                f"{name}: {len(iterative_changes)} changes | "
+                f"recursive {recursive_time * 1000:.1f} ms | "
+                f"iterative {iterative_time * 1000:.1f} ms | "
+                f"speedup {recursive_time / iterative_time:.2f}x | "
+                f"copy-on-write {overlay_time * 1000:.1f} ms"
+            )
+
+        depth = sys.getrecursionlimit() * 2
+        base, target = deep_documents(depth, 1)
+        changes = merger.merge_yaml(base, target)
+        print(
+            f"deep (depth {depth}): iterative merge finished with {len(changes)} changes"
+        )
+
+
+if __name__ == "__main__":
+    main()
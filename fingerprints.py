@@ -0,0 +1,132 @@
+import hashlib
+
+
+def _scalar_token(value):
+    return f"{type(value).__name__}:{value!r}"
+
+
+def _shared_nodes(root):
+    # ids of the mappings and sequences reachable through more than one
+    # parent, each node expanded once.
+    seen = {id(root)}
+    shared = set()
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        for value in node.values() if isinstance(node, dict) else node:
+            if isinstance(value, (dict, list)):
+                if id(value) in seen:
+                    shared.add(id(value))
+                else:
+                    seen.add(id(value))
+                    stack.append(value)
+    return shared
+
+
+def subtree_fingerprints(root, skip_shared=False):
+    # Merkle fingerprints of every mapping and sequence under root, computed
+    # bottom-up in one pass and keyed by id(). Mapping digests do not depend
+    # on key order, so two subtrees with equal digests compare equal and
+    # merge_yaml can skip them. Nodes shared through aliases are hashed once.
+    # The table refers to nodes by id, so it is only valid while the tree is
+    # alive and unmodified.
+    #
+    # With skip_shared, shared nodes and every node above one get no digest:
+    # a merge can write to a shared node through one path and then reach it
+    # again through another, where a digest taken before the merge is stale.
+    table = {}
+    if not isinstance(root, (dict, list)):
+        return table
+    tainted = _shared_nodes(root) if skip_shared else set()
+
+    def child_token(value):
+        if isinstance(value, (dict, list)):
+            # A recursive alias back to an ancestor has no digest yet.
+            return table.get(id(value), "recursive")
+        return _scalar_token(value)
+
+    in_progress = set()
+    done = set()
+    stack = [(root, False)]
+    while stack:
+        node, expanded = stack.pop()
+        node_id = id(node)
+        if node_id in done:
+            continue
+        values = node.values() if isinstance(node, dict) else node
+        if not expanded:
+            in_progress.add(node_id)
+            stack.append((node, True))
+            for value in values:
+                if (
+                    isinstance(value, (dict, list))
+                    and id(value) not in done
+                    and id(value) not in in_progress
+                ):
+                    stack.append((value, False))
+            continue
+        in_progress.discard(node_id)
+        done.add(node_id)
+        if tainted and (
+            node_id in tainted
+            or any(
+                isinstance(value, (dict, list)) and id(value) in tainted
+                for value in values
+            )
+        ):
+            tainted.add(node_id)
+            continue
+        # Scalars enter their parent's digest as repr() tokens and nested
+        # containers as hex digests; NUL never appears in either.
+        if isinstance(node, dict):
+            content = "\0".join(
+                sorted(
+                    _scalar_token(key) + "\0" + child_token(value)
+                    for key, value in node.items()
+                )
+            )
+            content = "map\0" + content
+        else:
+            content = "seq\0" + "\0".join(child_token(value) for value in node)
+        table[node_id] = hashlib.blake2b(
+            content.encode("utf-8", "surrogatepass"), digest_size=16
+        ).hexdigest()
+    return table
+
+
+def _walk_containers(root):
+    # Mappings and sequences under root in document pre-order, each once.
+    # The order only depends on the document, so a table can be stored as
+    # a list of digests and restored onto another load of the same file.
+    if not isinstance(root, (dict, list)):
+        return
+    seen = {id(root)}
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        yield node
+        values = list(node.values() if isinstance(node, dict) else node)
+        for value in reversed(values):
+            if isinstance(value, (dict, list)) and id(value) not in seen:
+                seen.add(id(value))
+                stack.append(value)
+
+
+def ordered_digests(root, table):
+    return [table.get(id(node)) for node in _walk_containers(root)]
+
+
+def restore_fingerprints(root, digests):
+    table = {}
+    for node, digest in zip(_walk_containers(root), digests):
+        if digest is not None:
+            table[id(node)] = digest
+    return table
+
+
+def document_digest(root):
+    # Digest of a whole document, scalar documents included. Each node is
+    # hashed once, however many aliases refer to it.
+    if isinstance(root, (dict, list)):
+        return subtree_fingerprints(root)[id(root)]
+    return _scalar_token(root)
@@ -0,0 +1,334 @@
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from ruamel.yaml.comments import merge_attrib
+
+from key_path import KeyPath, ListItem
+
+SCALAR = 0
+MAPPING = 1
+SEQUENCE = 2
+KEYED_LIST = 3
+_INT_LIMIT = 1 << 62
+_MASK = (1 << 64) - 1
+
+
+class _Unsupported(Exception):
+    pass
+
+
+def _scalar_token(value):
+    # Scalars that compare equal get equal tokens, 1, 1.0 and True included,
+    # because merge_yaml compares values with ==. Integers are their own
+    # token, so small values cannot collide; everything else is hashed.
+    if isinstance(value, str):
+        return hash(value)
+    if isinstance(value, float):
+        if value != value or value in (float("inf"), float("-inf")):
+            raise _Unsupported
+        if not value.is_integer():
+            return hash(("float", value))
+        value = int(value)
+    if isinstance(value, int):
+        if -_INT_LIMIT < value < _INT_LIMIT:
+            return int(value)
+        return hash(("int", value))
+    try:
+        return hash((type(value).__name__, value))
+    except TypeError:
+        raise _Unsupported from None
+
+
+def _count_nodes(root, limit):
+    # Nodes under root, counted up to limit. Only containers are pushed;
+    # their children are counted from len().
+    count = 1
+    stack = [root] if isinstance(root, (dict, list)) else []
+    push = stack.append
+    while stack and count < limit:
+        node = stack.pop()
+        values = node.values() if isinstance(node, dict) else node
+        count += len(values)
+        for value in values:
+            if isinstance(value, (dict, list)):
+                push(value)
+    return count
+
+
+def _digests(root):
+    # Digest of every mapping and list under root by id(), built bottom-up
+    # from the scalar tokens: equal subtrees, as == sees them, get equal
+    # digests. Mapping digests do not depend on key order. Raises
+    # _Unsupported for nodes shared through aliases or "<<" merge keys.
+    table = {}
+    seen = set()
+
+    def token(value):
+        if isinstance(value, (dict, list)):
+            return table[id(value)]
+        return _scalar_token(value)
+
+    stack = [(root, False)]
+    while stack:
+        node, expanded = stack.pop()
+        values = node.values() if isinstance(node, dict) else node
+        if not expanded:
+            if id(node) in seen or hasattr(node, merge_attrib):
+                raise _Unsupported
+            seen.add(id(node))
+            stack.append((node, True))
+            for value in values:
+                if isinstance(value, (dict, list)):
+                    stack.append((value, False))
+            continue
+        if isinstance(node, dict):
+            total = 0
+            for key, value in node.items():
+                total += hash((_scalar_token(key), token(value)))
+            table[id(node)] = hash(("map", total & _MASK))
+        else:
+            table[id(node)] = hash(("seq", tuple(token(value) for value in node)))
+    return table
+
+
+class FlatDiff:
+    # Comparison engine for very large documents. Each document is flattened
+    # once into parallel arrays keyed by a hash of every node's path; the
+    # target paths are sorted and all base paths are matched against them
+    # with np.searchsorted, so added, updated and unchanged nodes fall out
+    # of array operations instead of a nested dict walk. The change records
+    # are the ones merge_yaml makes, in the same order.
+    #
+    # diff() returns None, and the caller walks the trees instead, when
+    # NumPy is not installed, the target has fewer than min_nodes nodes, or
+    # the documents need the sequential walk: nodes shared through aliases
+    # or "<<" merge keys, a list merge key value repeated within a base list
+    # (merge_yaml merges both elements into one target element in turn), or
+    # NaN and infinite floats, which do not compare like their digests.
+    def __init__(self, skip_rules, list_merge_keys, list_merge_field, min_nodes):
+        self.skip_rules = skip_rules
+        self.list_merge_keys = list_merge_keys
+        self.list_merge_field = list_merge_field
+        self.min_nodes = min_nodes
+
+    def diff(self, base, target):
+        if np is None or not (isinstance(base, dict) and isinstance(target, dict)):
+            return None
+        if _count_nodes(target, self.min_nodes) < self.min_nodes:
+            return None
+        try:
+            target_lists = {}
+            target_rows = self._flatten(target, _digests(target), target_lists, None)
+            base_rows = self._flatten(base, _digests(base), None, target_lists)
+        except _Unsupported:
+            return None
+        return self._compare(base_rows, target_rows)
+
+    def _target_fields(self, items):
+        # Every merge key the elements could be matched by. Which one is
+        # used depends on the base list too, so target elements are
+        # flattened under each of them.
+        return [
+            field
+            for field in self.list_merge_keys
+            if items
+            and all(
+                isinstance(item, dict)
+                and field in item
+                and not isinstance(item[field], (dict, list))
+                for item in items
+            )
+        ]
+
+    def _flatten(self, root, digests, target_lists, paired_lists):
+        # Pre-order walk emitting one row per mapping value and keyed list
+        # element, mirroring the nodes merge_yaml can reach. Plain list
+        # elements and everything below a skipped key only count through
+        # their parent's digest. On the target side lists are collected by
+        # path in target_lists; on the base side a list is keyed when
+        # list_merge_field() accepts it with the target list at its path.
+        # Rows are (path hash, parent row, depth, kind, digest, skipped,
+        # key, node).
+        rows = []
+        add = rows.append
+        step = self.skip_rules.step
+        stack = [(iter(root.items()), None, -1, 0, self.skip_rules.root, 0)]
+        while stack:
+            items, field, row, path, state, depth = stack[-1]
+            for entry in items:
+                if field is None:
+                    key, value = entry
+                    key_state = step(state, key)
+                    key_token = _scalar_token(key)
+                else:
+                    value = entry
+                    key = ListItem(field, value[field])
+                    key_state = state
+                    key_token = hash(("[]", field, _scalar_token(key.value)))
+                child_path = hash((path, key_token))
+                if isinstance(value, dict):
+                    kind = MAPPING
+                    digest = digests[id(value)]
+                elif isinstance(value, list):
+                    kind = SEQUENCE
+                    digest = digests[id(value)]
+                else:
+                    kind = SCALAR
+                    digest = _scalar_token(value)
+                fields = ()
+                if kind == SEQUENCE and not key_state.skipped:
+                    if target_lists is not None:
+                        target_lists.setdefault(child_path, value)
+                        fields = self._target_fields(value)
+                    elif child_path in paired_lists:
+                        list_field = self.list_merge_field(
+                            value, paired_lists[child_path]
+                        )
+                        if list_field is not None:
+                            tokens = {_scalar_token(item[list_field]) for item in value}
+                            if len(tokens) != len(value):
+                                raise _Unsupported
+                            kind = KEYED_LIST
+                            fields = (list_field,)
+                child_row = len(rows)
+                add(
+                    (
+                        child_path,
+                        row,
+                        depth,
+                        kind,
+                        digest,
+                        key_state.skipped,
+                        key,
+                        value,
+                    )
+                )
+                if key_state.skipped:
+                    continue
+                if kind == MAPPING:
+                    stack.append(
+                        (
+                            iter(value.items()),
+                            None,
+                            child_row,
+                            child_path,
+                            key_state,
+                            depth + 1,
+                        )
+                    )
+                    break
+                if fields:
+                    for list_field in reversed(fields):
+                        stack.append(
+                            (
+                                iter(value),
+                                list_field,
+                                child_row,
+                                child_path,
+                                key_state,
+                                depth + 1,
+                            )
+                        )
+                    break
+            else:
+                stack.pop()
+        return rows
+
+    def _compare(self, base_rows, target_rows):
+        if not base_rows:
+            return []
+        (
+            base_paths,
+            parent_rows,
+            depths,
+            base_kinds,
+            base_digests,
+            skipped,
+            keys,
+            base_nodes,
+        ) = zip(*base_rows)
+        base_paths = np.array(base_paths, dtype=np.int64)
+        parents = np.array(parent_rows, dtype=np.int64)
+        depths = np.array(depths, dtype=np.int64)
+        base_kinds = np.array(base_kinds, dtype=np.int8)
+        base_digests = np.array(base_digests, dtype=np.int64)
+        skipped = np.array(skipped, dtype=bool)
+        if target_rows:
+            target_paths, _, _, target_kinds, target_digests, _, _, target_nodes = zip(
+                *target_rows
+            )
+        else:
+            target_paths = target_kinds = target_digests = target_nodes = ()
+        target_paths = np.array(target_paths, dtype=np.int64)
+        target_kinds = np.array(target_kinds, dtype=np.int8)
+        target_digests = np.array(target_digests, dtype=np.int64)
+
+        # A stable sort keeps repeated paths in document order, so the
+        # leftmost match is the first target element with a repeated merge
+        # key value, the one merge_yaml matches.
+        if len(target_paths):
+            order = np.argsort(target_paths, kind="stable")
+            sorted_paths = target_paths[order]
+            position = np.searchsorted(sorted_paths, base_paths)
+            clipped = np.minimum(position, len(sorted_paths) - 1)
+            found = (position < len(sorted_paths)) & (
+                sorted_paths[clipped] == base_paths
+            )
+            match = order[clipped]
+            same = found & (base_digests == target_digests[match])
+            target_mapping = target_kinds[match] == MAPPING
+        else:
+            found = same = target_mapping = np.zeros(len(base_paths), dtype=bool)
+            match = None
+        descend = (
+            found
+            & ~skipped
+            & (
+                ((base_kinds == MAPPING) & target_mapping)
+                | ((base_kinds == KEYED_LIST) & ~same)
+            )
+        )
+
+        # A node is reached when every ancestor is descended into. Parents
+        # precede their children, so this resolves one depth at a time.
+        reached = depths == 0
+        for depth in range(1, int(depths.max()) + 1):
+            level = np.flatnonzero(depths == depth)
+            level_parents = parents[level]
+            reached[level] = reached[level_parents] & descend[level_parents]
+        reported = reached & ~skipped & ~descend & ~same
+
+        changes = []
+        key_paths = {}
+
+        def key_path(row):
+            chain = []
+            while row >= 0 and row not in key_paths:
+                chain.append(row)
+                row = parent_rows[row]
+            path = key_paths.get(row)
+            for row in reversed(chain):
+                path = key_paths[row] = KeyPath(path, keys[row])
+            return path
+
+        for row in np.flatnonzero(reported).tolist():
+            if not found[row]:
+                changes.append(
+                    {
+                        "path": key_path(row),
+                        "type": "added",
+                        "new": base_nodes[row],
+                    }
+                )
+            else:
+                changes.append(
+                    {
+                        "path": key_path(row),
+                        "type": "updated",
+                        "old": target_nodes[match[row]],
+                        "new": base_nodes[row],
+                    }
+                )
+        return changes
@@ -0,0 +1,46 @@
+class ListItem:
+    # Path segment of a list element matched by a merge key, rendered as
+    # "[name=web]" right after the list's own key.
+    __slots__ = ("field", "value")
+
+    def __init__(self, field, value):
+        self.field = field
+        self.value = value
+
+    def __str__(self):
+        return f"[{self.field}={self.value}]"
+
+
+class KeyPath:
+    # Path of a key as a link to its parent's path (None at the document
+    # root). Building a child path is O(1); the dotted string is only
+    # rendered when a report needs it, with dots and backslashes inside keys
+    # escaped so the rendering stays unambiguous.
+    __slots__ = ("parent", "key")
+
+    def __init__(self, parent, key):
+        self.parent = parent
+        self.key = key
+
+    def keys(self):
+        keys = []
+        node = self
+        while node is not None:
+            keys.append(node.key)
+            node = node.parent
+        keys.reverse()
+        return keys
+
+    def __str__(self):
+        parts = []
+        for key in self.keys():
+            if isinstance(key, ListItem):
+                parts.append(str(key))
+            else:
+                if parts:
+                    parts.append(".")
+                parts.append(str(key).replace("\\", "\\\\").replace(".", "\\."))
+        return "".join(parts)
+
+    def __repr__(self):
+        return f"KeyPath({str(self)!r})"
@@ -0,0 +1,51 @@
+import os
+import pickle
+
+from skip_rules import SkipRules
+from yaml_cache import TreeUnpickler
+
+PATCH_MAGIC = b"merge-yamls patch 1\n"
+
+
+class MergePatch:
+    # A base document compiled once for merging into many targets: the
+    # loaded tree with the skip/keep rules and list merge keys it is to be
+    # applied with, stored as one pickle behind PATCH_MAGIC. Loading it is
+    # an unpickle instead of a YAML parse, and values shared between the
+    # tree and its subtrees are stored once.
+    def __init__(self, base, skip_rules, keep_rules, list_merge_keys):
+        self.base = base
+        self.skip_rules = tuple(skip_rules)
+        self.keep_rules = tuple(keep_rules)
+        self.list_merge_keys = tuple(list_merge_keys)
+
+    def rules(self):
+        return SkipRules(self.skip_rules, self.keep_rules)
+
+    def dump(self, path):
+        # Written through a temporary file so a concurrent reader never
+        # sees half a patch.
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(PATCH_MAGIC)
+                pickle.dump(
+                    (self.base, self.skip_rules, self.keep_rules, self.list_merge_keys),
+                    f,
+                    protocol=pickle.HIGHEST_PROTOCOL,
+                )
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            if f.read(len(PATCH_MAGIC)) != PATCH_MAGIC:
+                raise ValueError(f"{path} is not a compiled merge patch")
+            base, skip_rules, keep_rules, list_merge_keys = TreeUnpickler(f).load()
+        return cls(base, skip_rules, keep_rules, list_merge_keys)
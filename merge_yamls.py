@@ -1,26 +1,588 @@
 import argparse
+import contextlib
+import glob
+import hashlib
+import io
 import json
 import os
+import pickle
+import re
+import shutil
 import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import zip_longest
 
+import ruamel.yaml
 from ruamel.yaml import YAML
-from ruamel.yaml.comments import CommentedMap, CommentedSeq
-from ruamel.yaml.scalarstring import LiteralScalarString
+from ruamel.yaml.comments import CommentedMap, CommentedSeq, merge_attrib
+from ruamel.yaml.representer import RoundTripRepresenter
+from ruamel.yaml.scalarstring import (
+    DoubleQuotedScalarString,
+    FoldedScalarString,
+    PlainScalarString,
+    ScalarString,
+    SingleQuotedScalarString,
+)
+
+from fingerprints import (
+    document_digest,
+    ordered_digests,
+    restore_fingerprints,
+    subtree_fingerprints,
+)
+from flat_diff import FlatDiff, _count_nodes
+from key_path import KeyPath, ListItem
+from merge_patch import MergePatch
+from path_index import PathIndex
+from skip_rules import SkipRules
+from stream_diff import StreamDiff, _uses_merge_keys
+from yaml_cache import DiskCache, content_hash, file_hash
+
+CONFIG_PATH = "config.json"
+DEFAULT_LIST_MERGE_KEYS = ("name", "containerPort")
+# Documents with fewer nodes than this are merged without a process pool.
+DEFAULT_PARALLEL_THRESHOLD = 1_000_000
+# Inputs totalling fewer bytes than this are parsed without a process pool;
+# the round-trip loader takes about a second per 100 KB.
+PARALLEL_PARSE_BYTES = 64 * 1024
+# Documents with at least this many nodes are compared by the NumPy engine
+# in flat_diff.py; 0 leaves it off.
+DEFAULT_FLAT_DIFF_THRESHOLD = 0
+# Stands in for a key that is absent from one side of a three-way merge.
+_MISSING = object()
+
+
+def _read_config(config_path):
+    if not os.path.exists(config_path):
+        return {}
+    try:
+        with open(config_path, "r") as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"Could not read {config_path}: {e}")
+        return {}
+
+
+def _load_json(raw):
+    # Machine-generated values are often JSON, which the stdlib C parser
+    # reads far faster than any YAML loader. Returns None when the content
+    # does not look like, or does not parse as, JSON.
+    if raw.lstrip()[:1] not in (b"{", b"["):
+        return None
+    try:
+        return json.loads(raw)
+    except ValueError:
+        return None
+
+
+def _semantic_hash(path, cache):
+    # Hash of the loaded documents, ignoring comments, whitespace and key
+    # order, or None when the safe loader cannot load the file (application
+    # tags such as !Ref). Cached by content hash, so it is only computed
+    # once per file.
+    key = DiskCache.make_key("semantic", file_hash(path), ruamel.yaml.__version__)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached.decode("ascii") or None
+    try:
+        with open(path, "r") as f:
+            docs = [document_digest(doc) for doc in YAML(typ="safe").load_all(f)]
+    except ruamel.yaml.YAMLError:
+        cache.put(key, b"")
+        return None
+    digest = content_hash("\n".join(docs).encode("utf-8"))
+    cache.put(key, digest.encode("ascii"))
+    return digest
+
+
+def _tool_version():
+    # Hash of this tool's own source files, so cached results are never
+    # reused by a different revision of the merge code.
+    digest = hashlib.sha256(ruamel.yaml.__version__.encode("ascii"))
+    here = os.path.dirname(os.path.abspath(__file__))
+    for path in sorted(glob.glob(os.path.join(here, "*.py"))):
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def _tree_hash(root):
+    # Hash of every file under root with its relative path.
+    digest = hashlib.sha256()
+    for directory, dirs, files in os.walk(root):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(directory, name)
+            digest.update(os.path.relpath(path, root).encode("utf-8") + b"\0")
+            digest.update(file_hash(path).encode("ascii"))
+    return digest.hexdigest()
+
+
+def _load_yaml_file(path, fast=False, cache_dir=None, cache_max_bytes=None):
+    # May run in a worker process, so each call builds its own YAML instance.
+    # The safe loader uses libyaml when available and builds plain
+    # dicts/lists; comments and formatting are lost, so it is only used when
+    # no merged YAML is written.
+    with open(path, "rb") as f:
+        raw = f.read()
+    if fast:
+        data = _load_json(raw)
+        if data is not None:
+            return data
+    cache = key = None
+    if cache_dir:
+        cache = DiskCache(cache_dir, cache_max_bytes)
+        key = DiskCache.make_key(
+            "parse", content_hash(raw), ruamel.yaml.__version__, fast
+        )
+        cached = cache.get_tree(key)
+        if cached is not None:
+            return cached
+    yaml = YAML(typ="safe") if fast else YAML()
+    data = yaml.load(raw.decode("utf-8"))
+    if cache is not None:
+        cache.put(key, pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL))
+    return data
+
+
+DOCUMENT_START_RE = re.compile(rb"^---(?:\s|$)")
+DOCUMENT_END_RE = re.compile(rb"^\.\.\.(?:\s|$)")
+PREAMBLE_RE = re.compile(rb"^(?:\s*(?:#.*)?|%.*)$")
+
+
+def _split_documents(path):
+    # Yields (byte offset, text) for each document of a multi-document file
+    # without holding more than one document in memory. Document markers at
+    # column 0 always end the preceding document, so splitting on them is
+    # safe; comments and directives before the first marker stay with the
+    # first document.
+    offset = 0
+    start = 0
+    lines = []
+    has_content = False
+    with open(path, "rb") as f:
+        for line in f:
+            if DOCUMENT_START_RE.match(line) and has_content:
+                yield start, b"".join(lines).decode("utf-8")
+                start, lines, has_content = offset, [], False
+            lines.append(line)
+            offset += len(line)
+            if DOCUMENT_END_RE.match(line):
+                yield start, b"".join(lines).decode("utf-8")
+                start, lines, has_content = offset, [], False
+            elif not PREAMBLE_RE.match(line):
+                has_content = True
+    if has_content:
+        yield start, b"".join(lines).decode("utf-8")
+
+
+DOUBLE_QUOTED_KEY_RE = re.compile(rb'"((?:[^"\\]|\\.)*)"[ \t]*:(?:\s|$)')
+SINGLE_QUOTED_KEY_RE = re.compile(rb"'((?:[^']|'')*)'[ \t]*:(?:\s|$)")
+PLAIN_KEY_RE = re.compile(rb"([^\s#'\"{\[\-?][^#\n]*?)[ \t]*:(?:\s|$)")
+
+
+def _line_key(line):
+    # Key of a block mapping entry, given its line without indentation.
+    match = DOUBLE_QUOTED_KEY_RE.match(line)
+    if match:
+        return json.loads(b'"' + match.group(1) + b'"')
+    match = SINGLE_QUOTED_KEY_RE.match(line)
+    if match:
+        return match.group(1).decode("utf-8").replace("''", "'")
+    match = PLAIN_KEY_RE.match(line)
+    if match:
+        return match.group(1).decode("utf-8")
+    return None
+
+
+def _continues_entry(line):
+    # Whether a line at an entry's own indentation, given without it, still
+    # belongs to the entry: an item of a block sequence written at its key's
+    # indentation (ruamel's default dump style) or the closing bracket of a
+    # flow value.
+    return (
+        line[:2] in (b"- ", b"-\t") or line.rstrip() == b"-" or line[:1] in (b"]", b"}")
+    )
+
+
+def _index_keys(data, start, end, indent=None):
+    # Maps each block mapping key found at one indentation level of
+    # data[start:end] to its (start, end, indent) byte range, found with a
+    # line scan rather than a parse. The level defaults to the indentation of
+    # the first content line; comments and blank lines after an entry belong
+    # to it, and so do the lines _continues_entry() accepts.
+    index = {}
+    current = None
+    pos = start
+    while pos < end:
+        line_end = data.find(b"\n", pos, end)
+        line_end = end if line_end == -1 else line_end + 1
+        stripped = data[pos:line_end].lstrip(b" ")
+        column = line_end - pos - len(stripped)
+        if stripped.strip() and not stripped.startswith(b"#"):
+            if indent is None:
+                indent = column
+            if column == indent and not (
+                current is not None and _continues_entry(stripped)
+            ):
+                if current is not None:
+                    index.setdefault(current[0], (current[1], pos, indent))
+                key = _line_key(stripped)
+                current = (key, pos) if key is not None else None
+        pos = line_end
+    if current is not None:
+        index.setdefault(current[0], (current[1], end, indent))
+    return index
+
+
+def _shallow_copy(node):
+    # A copy of one mapping or list for the copy-on-write merge. Comments,
+    # anchors and formatting are kept; the children are shared.
+    if isinstance(node, CommentedMap):
+        return node.copy()
+    if isinstance(node, CommentedSeq):
+        return node.copy_attributes(CommentedSeq(node))
+    return type(node)(node)
+
+
+def _format_value(val):
+    if isinstance(val, (dict, list)):
+        return json.dumps(val, ensure_ascii=False)
+    return str(val)
+
+
+def _format_change(change):
+    if change["type"] == "updated":
+        line = f"{change['path']}: updated | old: {_format_value(change['old'])} | new: {_format_value(change['new'])}"
+    elif change["type"] == "added":
+        line = f"{change['path']}: added | new: {_format_value(change['new'])}"
+    else:
+        line = f"{change['path']}: removed | old: {_format_value(change['old'])}"
+    if "source" in change:
+        line += f" | from: {change['source']}"
+    return line
+
+
+def _path_segments(path):
+    # Hashable form of a KeyPath; list items cannot collide with keys.
+    return tuple(
+        (ListItem, key.field, key.value) if isinstance(key, ListItem) else key
+        for key in path.keys()
+    )
+
+
+def _value_at(root, segments, lists):
+    # The node at segments (see _path_segments) below root, or _MISSING. A
+    # list element is the first one with the merge key value; lists maps
+    # (id(list), field) to an index of those, built on the first lookup.
+    node = root
+    for segment in segments:
+        if isinstance(segment, tuple) and segment and segment[0] is ListItem:
+            _, field, value = segment
+            if not isinstance(node, list):
+                return _MISSING
+            index = lists.get((id(node), field))
+            if index is None:
+                index = lists[(id(node), field)] = {}
+                for item in node:
+                    if isinstance(item, dict) and field in item:
+                        index.setdefault(item[field], item)
+            node = index.get(value, _MISSING)
+        elif isinstance(node, dict):
+            node = node.get(segment, _MISSING)
+        else:
+            return _MISSING
+        if node is _MISSING:
+            return _MISSING
+    return node
+
+
+class _MergeFrame:
+    # A mapping or keyed list on YamlMerger._merge()'s stack: the base and
+    # target nodes, the path and skip rule state, the iterator over the
+    # base side, for keyed lists the merge field and a dict of target
+    # element positions by that field, the parent frame, the key or
+    # position in the parent, and whether target belongs to the merged
+    # tree already.
+    __slots__ = (
+        "base",
+        "target",
+        "path",
+        "state",
+        "items",
+        "list_index",
+        "parent",
+        "slot",
+        "writable",
+    )
+
+    def __init__(
+        self, base, target, path, state, items, list_index, parent, slot, writable
+    ):
+        self.base = base
+        self.target = target
+        self.path = path
+        self.state = state
+        self.items = items
+        self.list_index = list_index
+        self.parent = parent
+        self.slot = slot
+        self.writable = writable
+
+
+class _LayerFrame:
+    # A mapping on YamlMerger._walk_layers()'s stack: the mapping of the
+    # result, the group of (layer index, mapping) pairs merged into it, the
+    # path and skip rule state, the iterator over the group's keys, the
+    # parent frame, the key in the parent, whether node belongs to the
+    # merged tree already, and owner, the record of the value an earlier
+    # layer added or replaced above the frame, which the frame's changes
+    # add their layers to instead of being reported.
+    __slots__ = (
+        "node",
+        "group",
+        "path",
+        "state",
+        "keys",
+        "parent",
+        "slot",
+        "writable",
+        "owner",
+    )
+
+    def __init__(self, node, group, path, state, keys, parent, slot, writable, owner):
+        self.node = node
+        self.group = group
+        self.path = path
+        self.state = state
+        self.keys = keys
+        self.parent = parent
+        self.slot = slot
+        self.writable = writable
+        self.owner = owner
+
+
+class _ChangePrinter:
+    # Takes the place of the change list in --diff-only mode and writes
+    # every record out as soon as the walk makes it.
+    def __init__(self, stream):
+        self.stream = stream
+
+    def append(self, change):
+        self.stream.write(_format_change(change) + "\n")
+
+
+class _Tee(io.TextIOBase):
+    # Writes through to stream and keeps a copy of everything written, so
+    # a run's messages can be stored with its cached result.
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer = io.StringIO()
+
+    def write(self, text):
+        self.buffer.write(text)
+        return self.stream.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+def _has_merge_keys(*roots):
+    # Whether any mapping under the roots was built with a "<<" merge key.
+    # Each node is visited once, however many aliases refer to it.
+    seen = set()
+    pending = [root for root in roots if isinstance(root, (dict, list))]
+    while pending:
+        node = pending.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        if isinstance(node, dict):
+            if hasattr(node, merge_attrib):
+                return True
+            values = node.values()
+        else:
+            values = node
+        pending.extend(value for value in values if isinstance(value, (dict, list)))
+    return False
+
+
+def _top_level_sizes(base, target):
+    # Node count of every top-level subtree, base and target together, or
+    # None when the subtrees are not independent: a node shared by two of
+    # them through an alias or a "<<" merge key would be split in two by
+    # pickling each subtree on its own. Only containers and scalars that
+    # are not plain builtins (anchored ruamel scalars) can be shared.
+    plain = {str, int, float, bool, type(None)}
+    sizes = {}
+    owners = {}
+    for tree in (base, target):
+        for key, value in tree.items():
+            count = 1
+            pending = [value] if type(value) not in plain else []
+            while pending:
+                node = pending.pop()
+                if owners.setdefault(id(node), key) != key:
+                    return None
+                if isinstance(node, dict):
+                    if hasattr(node, merge_attrib):
+                        return None
+                    values = node.values()
+                elif isinstance(node, list):
+                    values = node
+                else:
+                    continue
+                count += len(values)
+                pending.extend(v for v in values if type(v) not in plain)
+            sizes[key] = sizes.get(key, 0) + count
+    return sizes
+
+
+_worker_merger = None
+
+
+def _init_merge_worker(skip_rules, list_merge_keys, report_removed, prune):
+    global _worker_merger
+    # diff_only keeps the constructor from creating the output directory.
+    _worker_merger = YamlMerger(
+        os.devnull, os.devnull, parallel_threshold=0, diff_only=True
+    )
+    _worker_merger.skip_rules = skip_rules
+    _worker_merger.list_merge_keys = list_merge_keys
+    _worker_merger.report_removed = report_removed
+    _worker_merger.prune = prune
+
+
+def _merge_subtrees(jobs):
+    # Runs in a worker process. Merges each (key, base value, target value)
+    # job and returns its change records with the merged value, or None
+    # when nothing changed.
+    results = []
+    for key, base_value, target_value in jobs:
+        merged = {key: target_value}
+        changes = _worker_merger.merge_yaml({key: base_value}, merged)
+        results.append((changes, merged[key] if changes else None))
+    return results
+
+
+class _MergedYamlRepresenter(RoundTripRepresenter):
+    # Writes multi-line strings as literal blocks. This happens while
+    # dumping rather than by rewriting the tree, because a merged tree
+    # shares its unchanged subtrees with the inputs.
+    def represent_multiline_str(self, data):
+        if "\n" not in data:
+            return RoundTripRepresenter.yaml_representers[type(data)](self, data)
+        anchor = data.yaml_anchor(any=True) if isinstance(data, ScalarString) else None
+        return self.represent_scalar(
+            "tag:yaml.org,2002:str", data, style="|", anchor=anchor
+        )
+
+
+for _str_type in (
+    str,
+    PlainScalarString,
+    SingleQuotedScalarString,
+    DoubleQuotedScalarString,
+    FoldedScalarString,
+):
+    _MergedYamlRepresenter.add_representer(
+        _str_type, _MergedYamlRepresenter.represent_multiline_str
+    )
 
 
 class YamlMerger:
-    def __init__(self, base_yaml, next_version_yaml, validate_helm=False):
+    def __init__(
+        self,
+        base_yaml,
+        next_version_yaml,
+        validate_helm=False,
+        fast=False,
+        cache_dir=None,
+        cache_max_mb=512,
+        stream=False,
+        multi_doc=False,
+        doc_key=None,
+        only_path=None,
+        use_fingerprints=False,
+        ancestor_yaml=None,
+        parallel_threshold=None,
+        diff_only=False,
+        flat_diff_threshold=None,
+        query=None,
+        overlays=(),
+        removed=False,
+        prune=False,
+        compile_patch=None,
+        base_is_patch=False,
+    ):
         self.base_yaml = base_yaml
         self.next_version_yaml = next_version_yaml
         self.validate_helm = validate_helm
-        self.next_version_duplicate = self.next_version_yaml.replace(
-            ".yml", "_duplicate.yml"
+        self.diff_only = diff_only
+        # Diff-only runs never write YAML, so comments need not be loaded.
+        self.fast = fast or diff_only
+        self.cache_dir = cache_dir
+        self.cache_max_bytes = cache_max_mb * 1024 * 1024
+        self.stream = stream
+        self.multi_doc = multi_doc or bool(doc_key)
+        self.doc_key = [field.split(".") for field in doc_key] if doc_key else None
+        self.only_path = only_path.split(".") if only_path else None
+        self.use_fingerprints = use_fingerprints
+        self.ancestor_yaml = ancestor_yaml
+        self.overlays = list(overlays)
+        # Keys and keyed list elements only the next version has are
+        # reported as removed and, with prune, left out of the result.
+        self.report_removed = removed or prune
+        self.prune = prune
+        self.conflicts = []
+        config = _read_config(CONFIG_PATH)
+        self.skip_rules = SkipRules.from_config(config)
+        self.list_merge_keys = tuple(
+            config.get("list_merge_keys", DEFAULT_LIST_MERGE_KEYS)
         )
+        if parallel_threshold is None:
+            parallel_threshold = config.get(
+                "parallel_threshold", DEFAULT_PARALLEL_THRESHOLD
+            )
+        self.parallel_threshold = parallel_threshold
+        if flat_diff_threshold is None:
+            flat_diff_threshold = config.get(
+                "flat_diff_threshold", DEFAULT_FLAT_DIFF_THRESHOLD
+            )
+        self.flat_diff_threshold = flat_diff_threshold
+        self.query = query
+        # Output path of a compiled patch of base_yaml; see write_patch().
+        self.compile_patch = compile_patch
+        # base_yaml is a patch written by --compile-patch. Patches are
+        # unpickled, so they are only loaded when asked for with --patch,
+        # never recognised by their content.
+        self.base_is_patch = base_is_patch
         self.yaml = YAML()
+        self.yaml.Representer = _MergedYamlRepresenter
+        self.yaml.explicit_start = self.multi_doc
         self.output_dir = "output"
-        os.makedirs(self.output_dir, exist_ok=True)
-        self.merge_output_path = self._get_merge_output_path()
+        if not (diff_only or query or compile_patch):
+            os.makedirs(self.output_dir, exist_ok=True)
+        self.merge_output_path = None
+        if next_version_yaml is not None:
+            self.merge_output_path = self._get_merge_output_path()
         self.changes = []
+        self.merged_data = None
+
+    def inputs_identical(self):
+        if os.path.getsize(self.base_yaml) == os.path.getsize(
+            self.next_version_yaml
+        ) and file_hash(self.base_yaml) == file_hash(self.next_version_yaml):
+            return True
+        if not self.cache_dir:
+            return False
+        # Files the safe loader cannot load are merged as usual.
+        cache = DiskCache(self.cache_dir, self.cache_max_bytes)
+        base_hash = _semantic_hash(self.base_yaml, cache)
+        return base_hash is not None and base_hash == _semantic_hash(
+            self.next_version_yaml, cache
+        )
 
     def _get_merge_output_path(self):
         base_filename = os.path.basename(self.next_version_yaml)
@@ -32,96 +594,1307 @@ class YamlMerger:
             merge_filename = base_filename + "_merge.yaml"
         return os.path.join(self.output_dir, merge_filename)
 
-    def duplicate_next_version(self):
-        if os.path.abspath(self.next_version_yaml) != os.path.abspath(
-            self.next_version_duplicate
+    def load_yamls(self, index=False):
+        paths = [self.base_yaml, self.next_version_yaml]
+        if self.ancestor_yaml:
+            paths.append(self.ancestor_yaml)
+        paths.extend(self.overlays)
+        # A compiled base is unpickled here rather than parsed.
+        parsed = paths[1:] if self.base_is_patch else paths
+        args = (self.fast, self.cache_dir, self.cache_max_bytes)
+        # The files are parsed in worker processes only when there are two
+        # CPUs and two files to share, and enough YAML to outweigh starting
+        # the pool and pickling every tree back.
+        workers = min(len(parsed), os.cpu_count() or 1)
+        if (
+            workers >= 2
+            and sum(os.path.getsize(path) for path in parsed) >= PARALLEL_PARSE_BYTES
         ):
-            with open(self.next_version_yaml, "r") as src, open(
-                self.next_version_duplicate, "w"
-            ) as dst:
-                data = self.yaml.load(src)
-                self.yaml.dump(data, dst)
-            print(f"Created duplicate: {self.next_version_duplicate}")
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(_load_yaml_file, path, *args) for path in parsed]
+                if self.base_is_patch:
+                    # Unpickled while the workers parse the other files.
+                    self.use_patch(MergePatch.load(self.base_yaml))
+                results = [future.result() for future in futures]
+        else:
+            if self.base_is_patch:
+                self.use_patch(MergePatch.load(self.base_yaml))
+            results = [_load_yaml_file(path, *args) for path in parsed]
+        if not self.base_is_patch:
+            self.base_data = results.pop(0)
+        self.next_version_data = results.pop(0)
+        if self.ancestor_yaml:
+            self.ancestor_data = results.pop(0)
+        self.overlay_data = results
+        if index:
+            self.base_index = PathIndex(self.base_data)
+            self.next_version_index = PathIndex(self.next_version_data)
+
+    def use_patch(self, patch):
+        # A compiled base brings its own rules, which replace config.json's.
+        self.base_data = patch.base
+        self.skip_rules = patch.rules()
+        self.list_merge_keys = patch.list_merge_keys
+
+    def apply_patch(self, patch, target, fingerprints=None):
+        # Merges a compiled base into target copy-on-write; see
+        # merge_overlay(). Returns (merged, changes).
+        self.use_patch(patch)
+        return self.merge_overlay(patch.base, target, fingerprints)
+
+    def write_patch(self):
+        # Parses base_yaml once and stores it, with the current rules, for
+        # merging into any number of next versions without parsing it again.
+        base = _load_yaml_file(
+            self.base_yaml, self.fast, self.cache_dir, self.cache_max_bytes
+        )
+        # Top-level keys the rules skip are never merged or added, so they
+        # are left out; skipped keys further down are kept, as they are
+        # part of any value that is added whole.
+        if isinstance(base, dict):
+            for key in [
+                key
+                for key in base
+                if self.skip_rules.step(self.skip_rules.root, key).skipped
+            ]:
+                del base[key]
+        MergePatch(
+            base,
+            self.skip_rules.skip_rules,
+            self.skip_rules.keep_rules,
+            self.list_merge_keys,
+        ).dump(self.compile_patch)
+        print(f"Merge patch written to: {self.compile_patch}")
+
+    def _load_document(self, text):
+        if self.fast:
+            data = _load_json(text.encode("utf-8"))
+            if data is not None:
+                return data
+        loader = YAML(typ="safe") if self.fast else self.yaml
+        return loader.load(text)
+
+    def _document_key(self, doc):
+        key = []
+        for field in self.doc_key:
+            value = doc
+            for part in field:
+                value = value.get(part) if isinstance(value, dict) else None
+            key.append(value)
+        return tuple(key)
+
+    def iter_document_pairs(self):
+        if not self.doc_key:
+            pairs = zip_longest(
+                _split_documents(self.base_yaml),
+                _split_documents(self.next_version_yaml),
+            )
+            for index, (base_doc, next_doc) in enumerate(pairs):
+                yield (
+                    f"[{index}]",
+                    self._load_document(base_doc[1]) if base_doc else None,
+                    self._load_document(next_doc[1]) if next_doc else None,
+                )
+            return
+        # Only byte ranges of the base documents are indexed, so a matching
+        # base document is re-read from disk when its partner comes up.
+        base_index = {}
+        for offset, text in _split_documents(self.base_yaml):
+            doc = self._load_document(text)
+            base_index.setdefault(self._document_key(doc), []).append(
+                (offset, len(text.encode("utf-8")))
+            )
+        with open(self.base_yaml, "rb") as base_file:
+
+            def read_base(offset, length):
+                base_file.seek(offset)
+                return self._load_document(base_file.read(length).decode("utf-8"))
+
+            for _, text in _split_documents(self.next_version_yaml):
+                next_doc = self._load_document(text)
+                key = self._document_key(next_doc)
+                ranges = base_index.get(key)
+                base_doc = read_base(*ranges.pop(0)) if ranges else None
+                yield "/".join(str(part) for part in key), base_doc, next_doc
+            for key, ranges in base_index.items():
+                for offset, length in ranges:
+                    yield "/".join(str(part) for part in key), read_base(
+                        offset, length
+                    ), None
+
+    def merge_documents(self):
+        for label, base_doc, next_doc in self.iter_document_pairs():
+            if next_doc is None:
+                self.changes.append(
+                    {"path": KeyPath(None, label), "type": "added", "new": base_doc}
+                )
+                yield base_doc
+            elif base_doc is None:
+                if self.report_removed:
+                    self.changes.append(
+                        {
+                            "path": KeyPath(None, label),
+                            "type": "removed",
+                            "old": next_doc,
+                        }
+                    )
+                if not self.prune:
+                    yield next_doc
+            else:
+                merge = self.diff_yaml if self.diff_only else self.merge_yaml
+                merge(
+                    base_doc,
+                    next_doc,
+                    KeyPath(None, label),
+                    self.changes,
+                    state=self.skip_rules.root,
+                    fingerprints=self.document_fingerprints(base_doc, next_doc),
+                )
+                yield next_doc
+
+    def _locate_only_path(self, data):
+        # Returns (start, end, indent, parent key line) of the smallest
+        # indexed range holding only_path: its second-level entry when that
+        # is a block mapping entry, otherwise the whole top-level entry.
+        top = _index_keys(data, 0, len(data), 0).get(self.only_path[0])
+        if top is None:
+            return None
+        start, end, _ = top
+        if len(self.only_path) > 1:
+            body = data.find(b"\n", start, end)
+            body = end if body == -1 else body + 1
+            child = _index_keys(data, body, end).get(self.only_path[1])
+            if child is not None and child[2] > 0:
+                return child + (data[start:body],)
+        return start, end, 0, b""
+
+    def _load_range(self, data, location):
+        if location is None:
+            return CommentedMap()
+        start, end, _, parent_line = location
+        loader = YAML(typ="safe") if self.fast else self.yaml
+        return loader.load((parent_line + data[start:end]).decode("utf-8"))
+
+    def merge_only_path(self):
+        with open(self.base_yaml, "rb") as f:
+            base_bytes = f.read()
+        with open(self.next_version_yaml, "rb") as f:
+            self.next_version_bytes = f.read()
+        base_part = self._load_range(base_bytes, self._locate_only_path(base_bytes))
+        self.next_version_location = self._locate_only_path(self.next_version_bytes)
+        self.next_version_data = self._load_range(
+            self.next_version_bytes, self.next_version_location
+        )
+        # Narrow base to just only_path so merge_yaml leaves the rest of a
+        # loaded range alone.
+        value = base_part
+        for part in self.only_path:
+            if not isinstance(value, dict) or part not in value:
+                return []
+            value = value[part]
+        base_selection = value
+        for part in reversed(self.only_path):
+            base_selection = CommentedMap([(part, base_selection)])
+        merge = self.diff_yaml if self.diff_only else self.merge_yaml
+        return merge(base_selection, self.next_version_data, changes=self.changes)
+
+    def write_only_path_yaml(self):
+        data = self.next_version_bytes
+        if not self.changes:
+            with open(self.merge_output_path, "wb") as f:
+                f.write(data)
+            print(f"Merged YAML written to: {self.merge_output_path}")
+            return
+        region = self.next_version_data
+        if self.next_version_location is None:
+            start = end = len(data)
+            indent = 0
+            if data and not data.endswith(b"\n"):
+                region_prefix = "\n"
+            else:
+                region_prefix = ""
         else:
-            print("Source and duplicate file names are the same. Skipping copy.")
-
-    def load_yamls(self):
-        with open(self.base_yaml, "r") as f:
-            self.base_data = self.yaml.load(f)
-        with open(self.next_version_duplicate, "r") as f:
-            self.next_version_data = self.yaml.load(f)
-
-    def quote_strings_inplace(self, obj):
-        if isinstance(obj, CommentedMap):
-            for k, v in obj.items():
-                obj[k] = self.quote_strings_inplace(v)
-            return obj
-        if isinstance(obj, CommentedSeq):
-            for idx, v in enumerate(obj):
-                obj[idx] = self.quote_strings_inplace(v)
-            return obj
-        if isinstance(obj, str):
-            if "\n" in obj:
-                return LiteralScalarString(obj)
-            return obj
-        return obj
-
-    def merge_yaml(self, base, target, path=None, changes=None):
-        if path is None:
-            path = []
+            start, end, indent, parent_line = self.next_version_location
+            if parent_line:
+                region = region[self.only_path[0]]
+            region_prefix = ""
+        buffer = io.StringIO()
+        self.yaml.dump(region, buffer)
+        text = "".join(
+            " " * indent + line if line.strip() else line
+            for line in buffer.getvalue().splitlines(keepends=True)
+        )
+        with open(self.merge_output_path, "wb") as f:
+            f.write(data[:start])
+            f.write((region_prefix + text).encode("utf-8"))
+            f.write(data[end:])
+        print(f"Merged YAML written to: {self.merge_output_path}")
+
+    def _fingerprints(self, data, path=None):
+        # With --cache-dir, the table of a whole input file is stored as its
+        # digests in document order, keyed by the file's content hash.
+        if not (path and self.cache_dir):
+            return subtree_fingerprints(data, True)
+        cache = DiskCache(self.cache_dir, self.cache_max_bytes)
+        key = DiskCache.make_key(
+            "fingerprints", file_hash(path), ruamel.yaml.__version__, self.fast
+        )
+        cached = cache.get_tree(key)
+        if cached is not None:
+            return restore_fingerprints(data, cached)
+        table = subtree_fingerprints(data, True)
+        cache.put(
+            key,
+            pickle.dumps(
+                ordered_digests(data, table), protocol=pickle.HIGHEST_PROTOCOL
+            ),
+        )
+        return table
+
+    def document_fingerprints(self, base, target, paths=(None, None)):
+        if not self.use_fingerprints:
+            return None
+        return self._fingerprints(base, paths[0]), self._fingerprints(target, paths[1])
+
+    def list_merge_field(self, base_list, target_list):
+        # The first configured merge key that every element of both lists
+        # has with a scalar value, so elements can be matched by it.
+        if not (
+            isinstance(base_list, list)
+            and isinstance(target_list, list)
+            and base_list
+            and target_list
+        ):
+            return None
+        for field in self.list_merge_keys:
+            if all(
+                isinstance(item, dict)
+                and field in item
+                and not isinstance(item[field], (dict, list))
+                for items in (base_list, target_list)
+                for item in items
+            ):
+                return field
+        return None
+
+    def merge_yaml(
+        self,
+        base,
+        target,
+        path=None,
+        changes=None,
+        visited=None,
+        state=None,
+        fingerprints=None,
+    ):
+        # Merges base into target in place and returns the change records.
+        # path is a KeyPath, or None at the document root.
         if changes is None:
             changes = []
-        resource_keys = {
-            "resources",
-            "limits",
-            "requests",
-            "cpu",
-            "memory",
-            "ephemeral-storage",
-        }
-        for key in base:
-            if key in ("tag", "envNFVersion"):
-                continue
-            if key in resource_keys:
-                continue
-            if key == "extraContainersTpl":
-                continue
-            current_path = path + [str(key)]
-            if key not in target:
-                target[key] = base[key]
-                changes.append(
-                    {
-                        "path": ".".join(current_path),
-                        "type": "added",
-                        "new": base[key],
-                    }
+        self._merge(base, target, path, changes, visited, state, fingerprints)
+        return changes
+
+    def merge_overlay(self, base, target, fingerprints=None):
+        # Copy-on-write merge that leaves both inputs untouched. The result
+        # shares every unchanged subtree with target (and added values with
+        # base) and only copies the mappings and lists on the path to a
+        # change, so merging one target against many bases costs O(changes)
+        # memory per merge. Returns (merged, changes).
+        changes = []
+        merged = self._merge(
+            base, target, None, changes, None, None, fingerprints, copy_on_write=True
+        )
+        return merged, changes
+
+    def merge_layers(self, target, layers, fingerprints=None):
+        # Applies (source, data) layers to target in order, each winning over
+        # the ones before it as with helm's repeated -f, in one walk over
+        # all layers at once (see _walk_layers). Changes are those of target
+        # against the result: old values come from target and new ones from
+        # the result. A value a layer added or replaced is reported once, at
+        # the path it was set at, and names under "source" that layer and
+        # every later one that merged into it. Returns (merged, changes).
+        # fingerprints is an optional table of target's subtrees.
+        in_place = _has_merge_keys(target, *(data for _, data in layers))
+        if not in_place:
+            result = self._walk_layers(target, layers, fingerprints)
+            if result is not None:
+                return self._name_sources(*result, layers)
+        return self._name_sources(
+            *self._fold_layers(target, layers, fingerprints, in_place), layers
+        )
+
+    def _fold_layers(self, target, layers, fingerprints=None, in_place=False):
+        # The layers merged one after the other, for documents the walk
+        # cannot handle. Values reached through "<<" are only updated by
+        # assigning to the mapping they are merged into, so documents with
+        # merge keys are merged in place.
+        original = None if in_place else target
+        passes = []
+        for index, (_, data) in enumerate(layers):
+            layer_fingerprints = None
+            if fingerprints is not None:
+                layer_fingerprints = (subtree_fingerprints(data, True), fingerprints)
+            if in_place:
+                # The table no longer matches the mutated target.
+                changes = self.merge_yaml(data, target, fingerprints=layer_fingerprints)
+                fingerprints = None
+            else:
+                target, changes = self.merge_overlay(
+                    data, target, fingerprints=layer_fingerprints
+                )
+            passes.append((index, changes))
+        return target, self._collapse_passes(passes, original, target)
+
+    @staticmethod
+    def _name_sources(merged, changes, layers):
+        for change in changes:
+            change["source"] = ", ".join(
+                layers[index][0] for index in sorted(change["source"])
+            )
+        return merged, changes
+
+    @staticmethod
+    def _surviving(passes):
+        # (layer index, record) pairs, in pass order, of the records of
+        # consecutive merge passes that no later pass overwrote at the same
+        # path or above.
+        overwritten = set()
+        survivors = []
+        for index, changes in reversed(passes):
+            paths = [_path_segments(change["path"]) for change in changes]
+            for change, segments in zip(reversed(changes), reversed(paths)):
+                if not any(
+                    segments[:length] in overwritten
+                    for length in range(1, len(segments) + 1)
+                ):
+                    survivors.append((index, change))
+            overwritten.update(paths)
+        survivors.reverse()
+        return survivors
+
+    @staticmethod
+    def _collapse_passes(passes, original, merged, depth=0):
+        # Turns the records of consecutive merge passes, as (layer index,
+        # changes) pairs, into the changes of original against merged.
+        # Records that a later pass overwrote at the same path or above are
+        # dropped, and records below the path of an earlier kept record
+        # only add their layer to its "source" set. Old values are looked
+        # up in original (the first record at the path when original was
+        # merged in place) and new ones in merged; record paths have depth
+        # leading segments above both roots.
+        survivors = {id(change) for _, change in YamlMerger._surviving(passes)}
+        first = {}
+        kept = {}
+        collapsed = []
+        lists = {}
+        for index, changes in passes:
+            for change in changes:
+                segments = _path_segments(change["path"])
+                first.setdefault(segments, change)
+                if id(change) not in survivors:
+                    continue
+                owner = None
+                for length in range(1, len(segments)):
+                    owner = kept.get(segments[:length])
+                    if owner is not None:
+                        break
+                if owner is not None:
+                    owner["source"].add(index)
+                    continue
+                if original is None:
+                    old = first[segments].get("old", _MISSING)
+                else:
+                    old = _value_at(original, segments[depth:], lists)
+                new = _value_at(merged, segments[depth:], lists)
+                if old is not _MISSING and old == new:
+                    continue
+                change = {"path": change["path"], "type": "added", "new": new}
+                if old is not _MISSING:
+                    change["type"] = "updated"
+                    change["old"] = old
+                change["source"] = {index}
+                kept[segments] = change
+                collapsed.append(change)
+        return collapsed
+
+    def _walk_layers(self, target, layers, fingerprints=None):
+        # Merges all layers into target copy-on-write in one depth-first walk
+        # of target and the layers side by side. A frame holds a mapping of
+        # the result together with the group of layer mappings at the same
+        # path; each key is resolved across the group in layer order, the
+        # way consecutive merges would resolve it, and a mapping that
+        # several layers merge into is walked once for all of them. Lists
+        # matched by a merge key are merged one layer after the other, as
+        # matching depends on the elements merged before. Returns None,
+        # leaving the merge to consecutive passes, when a node is reached a
+        # second time through an alias, or when a root is not a mapping.
+        if not isinstance(target, dict) or not all(
+            isinstance(data, dict) for _, data in layers
+        ):
+            return None
+        target_digests = fingerprints or {}
+        layer_digests = [
+            subtree_fingerprints(data, True) if fingerprints is not None else {}
+            for _, data in layers
+        ]
+        changes = []
+        record = changes.append
+        step = self.skip_rules.step
+        entered = set()
+
+        def enter(nodes):
+            ids = {id(node) for node in nodes}
+            if not entered.isdisjoint(ids):
+                return False
+            entered.update(ids)
+            return True
+
+        def writable(frame):
+            chain = []
+            while frame is not None and not frame.writable:
+                chain.append(frame)
+                frame = frame.parent
+            for frame in reversed(chain):
+                frame.node = _shallow_copy(frame.node)
+                frame.writable = True
+                if frame.parent is not None:
+                    frame.parent.node[frame.slot] = frame.node
+            return chain[0].node if chain else frame.node
+
+        def group_keys(group):
+            # Keys of the group's mappings in order of first appearance,
+            # so keys new to the result are added in the order consecutive
+            # merges would add them.
+            seen = set()
+            for _, data in group:
+                for key in data:
+                    if key not in seen:
+                        seen.add(key)
+                        yield key
+
+        def merge_keyed_list(path, state, key, value, later):
+            # Merges the later (layer index, list) pairs into value one
+            # after the other. Returns the result and the passes' records.
+            merged = {key: value}
+            passes = []
+            for index, data in later:
+                layer_changes = []
+                merged = self._merge(
+                    {key: data},
+                    merged,
+                    path,
+                    layer_changes,
+                    set(),
+                    state,
+                    None,
+                    copy_on_write=True,
                 )
+                passes.append((index, layer_changes))
+            return merged, passes
+
+        group = [(index, data) for index, (_, data) in enumerate(layers)]
+        if target_digests and group:
+            digest = target_digests.get(id(target))
+            while (
+                group
+                and digest is not None
+                and digest == layer_digests[group[0][0]].get(id(group[0][1]))
+            ):
+                group.pop(0)
+        if not enter([target] + [data for _, data in group]):
+            return None
+        root = _LayerFrame(
+            target,
+            group,
+            None,
+            self.skip_rules.root,
+            group_keys(group),
+            None,
+            None,
+            False,
+            None,
+        )
+        stack = [root]
+        while stack:
+            frame = stack[-1]
+            group, path, state = frame.group, frame.path, frame.state
+            owner = frame.owner
+            for key in frame.keys:
+                key_state = step(state, key)
+                if key_state.skipped:
+                    continue
+                original = frame.node.get(key, _MISSING)
+                value, source, members, later = original, None, [], None
+                values = [(index, data[key]) for index, data in group if key in data]
+                for index, layer_value in values:
+                    if later is not None:
+                        # Lists after one merged by key are merged into the
+                        # result in turn; anything else replaces it.
+                        if isinstance(layer_value, list):
+                            later.append((index, layer_value))
+                            continue
+                        later = None
+                        value, source, members = layer_value, index, []
+                    elif value is _MISSING:
+                        value, source, members = layer_value, index, []
+                    elif isinstance(layer_value, dict) and isinstance(value, dict):
+                        # An equal layer mapping leaves the target's
+                        # mapping unchanged while nothing merged into it.
+                        digest = layer_digests[index].get(id(layer_value))
+                        if (
+                            source is None
+                            and not members
+                            and digest is not None
+                            and digest == target_digests.get(id(value))
+                        ):
+                            continue
+                        members.append((index, layer_value))
+                    elif isinstance(layer_value, dict) or isinstance(value, dict):
+                        value, source, members = layer_value, index, []
+                    elif layer_value == value:
+                        continue
+                    elif (
+                        isinstance(layer_value, list)
+                        and isinstance(value, list)
+                        and self.list_merge_field(layer_value, value) is not None
+                    ):
+                        later = [(index, layer_value)]
+                    else:
+                        value, source, members = layer_value, index, []
+                child_path = KeyPath(path, key)
+                sources = set() if source is None else {source}
+                if later is not None:
+                    merged, passes = merge_keyed_list(path, state, key, value, later)
+                    if merged[key] is value:
+                        later = None
+                    else:
+                        for index, change in self._surviving(passes):
+                            if change["path"].parent is path:
+                                # A later layer replaced the whole list.
+                                sources = set()
+                                source = index
+                            sources.add(index)
+                        if source is None and owner is None:
+                            writable(frame)[key] = merged[key]
+                            for change in self._collapse_passes(
+                                passes,
+                                {key: value},
+                                merged,
+                                len(path.keys()) if path else 0,
+                            ):
+                                record(change)
+                            continue
+                        value = merged[key]
+                if source is None and later is None:
+                    if members:
+                        if not enter([value] + [data for _, data in members]):
+                            return None
+                        stack.append(
+                            _LayerFrame(
+                                value,
+                                members,
+                                child_path,
+                                key_state,
+                                group_keys(members),
+                                frame,
+                                key,
+                                False,
+                                owner,
+                            )
+                        )
+                        break
+                    continue
+                if members:
+                    if not enter([value] + [data for _, data in members]):
+                        return None
+                    value = _shallow_copy(value)
+                writable(frame)[key] = value
+                change = owner
+                if owner is not None:
+                    owner["source"].update(sources)
+                elif original is _MISSING or members or original != value:
+                    change = {"path": child_path, "type": "added", "new": value}
+                    if original is not _MISSING:
+                        change["type"] = "updated"
+                        change["old"] = original
+                    change["source"] = sources
+                    record(change)
+                if members:
+                    stack.append(
+                        _LayerFrame(
+                            value,
+                            members,
+                            child_path,
+                            key_state,
+                            group_keys(members),
+                            frame,
+                            key,
+                            True,
+                            change,
+                        )
+                    )
+                    break
+            else:
+                stack.pop()
+        return root.node, changes
+
+    def diff_yaml(
+        self,
+        base,
+        target,
+        path=None,
+        changes=None,
+        visited=None,
+        state=None,
+        fingerprints=None,
+    ):
+        # The change records merge_yaml would make, without modifying either
+        # tree. The walk runs copy-on-write and drops the result: a target
+        # node merged twice (a duplicated list merge key, an alias) must be
+        # compared the second time as the first merge left it.
+        if changes is None:
+            changes = []
+        if (
+            self.flat_diff_threshold
+            and not self.report_removed
+            and path is None
+            and visited is None
+            and state is None
+        ):
+            flat_changes = FlatDiff(
+                self.skip_rules,
+                self.list_merge_keys,
+                self.list_merge_field,
+                self.flat_diff_threshold,
+            ).diff(base, target)
+            if flat_changes is not None:
+                for change in flat_changes:
+                    changes.append(change)
+                return changes
+        self._merge(
+            base,
+            target,
+            path,
+            changes,
+            visited,
+            state,
+            fingerprints,
+            copy_on_write=True,
+        )
+        return changes
+
+    def _merge(
+        self,
+        base,
+        target,
+        path,
+        changes,
+        visited,
+        state,
+        fingerprints,
+        copy_on_write=False,
+    ):
+        # Returns the merged root: target itself, or its copy when
+        # copy_on_write is set and anything changed.
+        if visited is None and path is None and self.parallel_threshold:
+            merged = self._merge_parallel(
+                base, target, changes, fingerprints, copy_on_write
+            )
+            if merged is not None:
+                return merged
+        #
+        # fingerprints is an optional (base, target) pair of
+        # subtree_fingerprints() tables; subtrees whose digests match are
+        # equal and are skipped without being walked or compared.
+        base_digests, target_digests = fingerprints or ({}, {})
+        # state is the skip-rule state reached by path; each key steps it
+        # one segment further. List elements do not consume a segment.
+        if state is None:
+            keys = path.keys() if path else ()
+            state = self.skip_rules.state_for(
+                key for key in keys if not isinstance(key, ListItem)
+            )
+        # A mapping pair reached again through an alias has already been
+        # merged (the target node is shared too), so it is compared once and
+        # its changes are reported under the first path that reached it.
+        if visited is None:
+            visited = set()
+        # Copies made so far, by id() of the target node they replace and by
+        # their own id(). A target node reached again through an alias is
+        # swapped for its copy so the merged tree stays shared the way the
+        # input was.
+        copies = {}
+
+        # ids of target nodes written to in place, with their ancestors. A
+        # target node merged a second time (a list merge key repeated in the
+        # base list) no longer matches the digest taken before the merge.
+        written = set()
+        # Without copy-on-write or fingerprints there is nothing to copy or
+        # mark, and the walk writes to each frame's target directly.
+        plain = not (copy_on_write or target_digests)
+
+        def writable(frame):
+            # The frame's target, copied first, together with every ancestor
+            # not copied yet, when merging copy-on-write.
+            if target_digests:
+                marked = frame
+                while marked is not None and id(marked.target) not in written:
+                    written.add(id(marked.target))
+                    marked = marked.parent
+            chain = []
+            while frame is not None and not frame.writable:
+                chain.append(frame)
+                frame = frame.parent
+            for frame in reversed(chain):
+                node = copies.get(id(frame.target))
+                if node is None:
+                    node = copies[id(frame.target)] = _shallow_copy(frame.target)
+                    copies[id(node)] = node
+                frame.target = node
+                frame.writable = True
+                if frame.parent is not None:
+                    frame.parent.target[frame.slot] = node
+            return chain[0].target if chain else frame.target
+
+        def record_removed(frame):
+            # Entries of the frame's target that its base does not have,
+            # found once the base side is exhausted, so the walk covers the
+            # union of both sides in one pass.
+            base, target, path, state = (
+                frame.base,
+                frame.target,
+                frame.path,
+                frame.state,
+            )
+            list_index = frame.list_index
+            if list_index is None:
+                gone = [
+                    key
+                    for key in target
+                    if key not in base and not step(state, key).skipped
+                ]
+                for key in gone:
+                    record(
+                        {
+                            "path": KeyPath(path, key),
+                            "type": "removed",
+                            "old": target[key],
+                        }
+                    )
             else:
-                if isinstance(base[key], dict) and isinstance(target[key], dict):
-                    self.merge_yaml(base[key], target[key], current_path, changes)
-                elif base[key] != target[key]:
-                    old_value = target[key]
-                    target[key] = base[key]
-                    changes.append(
+                field = list_index[0]
+                base_values = {item[field] for item in base}
+                gone = [
+                    index
+                    for index, item in enumerate(target)
+                    if item[field] not in base_values
+                ]
+                for index in gone:
+                    record(
+                        {
+                            "path": KeyPath(
+                                path, ListItem(field, target[index][field])
+                            ),
+                            "type": "removed",
+                            "old": target[index],
+                        }
+                    )
+            if self.prune and gone:
+                node = writable(frame)
+                for slot in reversed(gone):
+                    del node[slot]
+
+        def descend(frame, slot, node):
+            # The node to walk below frame at slot, and whether it is
+            # already a copy that belongs to the merged tree.
+            node_copy = copies.get(id(node))
+            if node_copy is None:
+                return node, not copy_on_write
+            writable(frame)[slot] = node_copy
+            return node_copy, True
+
+        # Depth-first walk with an explicit stack of frames instead of
+        # recursion: nested mappings and keyed lists are pushed and resumed
+        # in the same order a recursive walk would visit them, and deep
+        # documents cannot hit the recursion limit. Mapping frames
+        # iterate base items and have no list index; keyed list frames
+        # iterate base elements and carry the merge field and a dict of
+        # target element positions by that field.
+        stack = []
+        push = stack.append
+        record = changes.append
+        step = self.skip_rules.step
+        list_merge_field = self.list_merge_field
+        report_removed = self.report_removed
+        root = _MergeFrame(
+            base, target, path, state, None, None, None, None, not copy_on_write
+        )
+        pair = (id(base), id(target))
+        if pair not in visited:
+            visited.add(pair)
+            root.items = iter(base.items())
+            push(root)
+        while stack:
+            frame = stack[-1]
+            target, path, state = frame.target, frame.path, frame.state
+            items, list_index = frame.items, frame.list_index
+            if list_index is not None:
+                field, target_items = list_index
+                for base_item in items:
+                    item_path = KeyPath(path, ListItem(field, base_item[field]))
+                    index = target_items.get(base_item[field])
+                    if index is None:
+                        (target if plain else writable(frame)).append(base_item)
+                        record({"path": item_path, "type": "added", "new": base_item})
+                        continue
+                    target_item = frame.target[index]
+                    if base_digests:
+                        digest = base_digests.get(id(base_item))
+                        if (
+                            digest is not None
+                            and id(target_item) not in written
+                            and digest == target_digests.get(id(target_item))
+                        ):
+                            continue
+                    pair = (id(base_item), id(target_item))
+                    if pair not in visited:
+                        visited.add(pair)
+                        copied = not copy_on_write
+                        if copies:
+                            target_item, copied = descend(frame, index, target_item)
+                        push(
+                            _MergeFrame(
+                                base_item,
+                                target_item,
+                                item_path,
+                                state,
+                                iter(base_item.items()),
+                                None,
+                                frame,
+                                index,
+                                copied,
+                            )
+                        )
+                        break
+                    if id(target_item) in copies:
+                        descend(frame, index, target_item)
+                else:
+                    if report_removed:
+                        record_removed(frame)
+                    stack.pop()
+                continue
+            for key, base_value in items:
+                key_state = step(state, key)
+                if key_state.skipped:
+                    continue
+                if key not in target:
+                    (target if plain else writable(frame))[key] = base_value
+                    record(
+                        {
+                            "path": KeyPath(path, key),
+                            "type": "added",
+                            "new": base_value,
+                        }
+                    )
+                    continue
+                target_value = target[key]
+                if base_digests:
+                    digest = base_digests.get(id(base_value))
+                    if (
+                        digest is not None
+                        and id(target_value) not in written
+                        and digest == target_digests.get(id(target_value))
+                    ):
+                        continue
+                if isinstance(base_value, dict) and isinstance(target_value, dict):
+                    pair = (id(base_value), id(target_value))
+                    if pair not in visited:
+                        visited.add(pair)
+                        copied = not copy_on_write
+                        if copies:
+                            target_value, copied = descend(frame, key, target_value)
+                        push(
+                            _MergeFrame(
+                                base_value,
+                                target_value,
+                                KeyPath(path, key),
+                                key_state,
+                                iter(base_value.items()),
+                                None,
+                                frame,
+                                key,
+                                copied,
+                            )
+                        )
+                        break
+                    if id(target_value) in copies:
+                        descend(frame, key, target_value)
+                elif base_value != target_value:
+                    field = None
+                    if isinstance(base_value, list):
+                        field = list_merge_field(base_value, target_value)
+                    if field is not None:
+                        # Elements are matched through a dict index of the
+                        # target list, so matching is O(n) rather than
+                        # pairwise, and changes are reported per element.
+                        target_items = {}
+                        for index, item in enumerate(target_value):
+                            target_items.setdefault(item[field], index)
+                        copied = not copy_on_write
+                        if copies:
+                            target_value, copied = descend(frame, key, target_value)
+                        push(
+                            _MergeFrame(
+                                base_value,
+                                target_value,
+                                KeyPath(path, key),
+                                key_state,
+                                iter(base_value),
+                                (field, target_items),
+                                frame,
+                                key,
+                                copied,
+                            )
+                        )
+                        break
+                    (target if plain else writable(frame))[key] = base_value
+                    record(
                         {
-                            "path": ".".join(current_path),
+                            "path": KeyPath(path, key),
                             "type": "updated",
-                            "old": old_value,
-                            "new": base[key],
+                            "old": target_value,
+                            "new": base_value,
                         }
                     )
-        return changes
+            else:
+                if report_removed:
+                    record_removed(frame)
+                stack.pop()
+        return root.target
+
+    def _merge_parallel(self, base, target, changes, fingerprints, copy_on_write):
+        # Merges every top-level subtree as a separate job, nested ones in a
+        # process pool, and reassembles the results in base key order so
+        # changes and output are exactly those of the serial walk. Returns
+        # None, leaving the merge to the serial walk, for documents below
+        # the threshold or whose top-level subtrees share nodes.
+        workers = os.cpu_count() or 1
+        if workers < 2 or not (isinstance(base, dict) and isinstance(target, dict)):
+            return None
+        # A bounded count first, so documents far below the threshold do
+        # not pay for the ownership walk of _top_level_sizes().
+        limit = self.parallel_threshold
+        if _count_nodes(base, limit) + _count_nodes(target, limit) < limit:
+            return None
+        sizes = _top_level_sizes(base, target)
+        if sizes is None or sum(sizes.values()) < self.parallel_threshold:
+            return None
+        base_digests, target_digests = fingerprints or ({}, {})
+        plan = []
+        jobs = []
+        for key, base_value in base.items():
+            target_value = target.get(key, _MISSING)
+            digest = base_digests.get(id(base_value))
+            if (
+                isinstance(base_value, (dict, list))
+                and isinstance(target_value, (dict, list))
+                and not self.skip_rules.step(self.skip_rules.root, key).skipped
+                and (digest is None or digest != target_digests.get(id(target_value)))
+            ):
+                plan.append((key, len(jobs)))
+                jobs.append((key, base_value, target_value))
+            else:
+                plan.append((key, None))
+        if len(jobs) < 2:
+            return None
+        # Consecutive jobs are grouped into chunks of roughly equal node
+        # counts, several per worker, so one large subtree does not leave
+        # the other workers idle and small ones share a round trip.
+        chunk_size = max(sum(sizes[job[0]] for job in jobs) // (workers * 4), 1)
+        chunks = []
+        chunk = []
+        size = 0
+        for job in jobs:
+            chunk.append(job)
+            size += sizes[job[0]]
+            if size >= chunk_size:
+                chunks.append(chunk)
+                chunk = []
+                size = 0
+        if chunk:
+            chunks.append(chunk)
+        with ProcessPoolExecutor(
+            max_workers=min(workers, len(chunks)),
+            initializer=_init_merge_worker,
+            initargs=(
+                self.skip_rules,
+                self.list_merge_keys,
+                self.report_removed,
+                self.prune,
+            ),
+        ) as pool:
+            results = [
+                result
+                for chunk_results in pool.map(_merge_subtrees, chunks)
+                for result in chunk_results
+            ]
+        merged = target
+        for key, job in plan:
+            if job is None:
+                key_changes = []
+                key_target = {key: target[key]} if key in target else {}
+                key_merged = self._merge(
+                    {key: base[key]},
+                    key_target,
+                    None,
+                    key_changes,
+                    set(),
+                    None,
+                    fingerprints,
+                    copy_on_write,
+                )
+                value = key_merged.get(key)
+            else:
+                key_changes, value = results[job]
+            if key_changes:
+                if copy_on_write and merged is target:
+                    merged = _shallow_copy(target)
+                merged[key] = value
+                # changes may be a _ChangePrinter, which only appends.
+                for change in key_changes:
+                    changes.append(change)
+        if self.report_removed:
+            gone = [
+                key
+                for key in target
+                if key not in base
+                and not self.skip_rules.step(self.skip_rules.root, key).skipped
+            ]
+            for key in gone:
+                changes.append(
+                    {"path": KeyPath(None, key), "type": "removed", "old": target[key]}
+                )
+            if self.prune and gone:
+                if copy_on_write and merged is target:
+                    merged = _shallow_copy(target)
+                for key in gone:
+                    del merged[key]
+        return merged
+
+    def merge_three_way(self, ancestor, base, target, changes=None, conflicts=None):
+        # ancestor holds the previous chart defaults, target the new chart
+        # defaults and base the site's customised values. Per key, and per
+        # element of a keyed list, the site value wins where only the site
+        # changed it, the new default stays where only the chart changed it,
+        # and a conflict is recorded where both changed it differently (the
+        # site value is kept, or the new default when the site deleted the
+        # key). target is updated in place.
+        if changes is None:
+            changes = []
+        if conflicts is None:
+            conflicts = []
+        ancestor_digests = subtree_fingerprints(ancestor)
+        base_digests = subtree_fingerprints(base)
+        target_digests = subtree_fingerprints(target)
+
+        def same(x, y, x_digests, y_digests):
+            # Containers compare by fingerprint, so each check is O(1).
+            if isinstance(x, (dict, list)) or isinstance(y, (dict, list)):
+                digest = x_digests.get(id(x))
+                return digest is not None and digest == y_digests.get(id(y))
+            return x == y
+
+        def frame(ancestor, base, target, path, state):
+            keys = list(base)
+            keys.extend(key for key in ancestor if key not in base)
+            return ancestor, base, target, path, state, iter(keys), None
+
+        def list_frame(ancestor, base, target, path, state, field):
+            # A keyed list is walked by element: the site's elements, then
+            # those only the ancestor has, each matched to the first
+            # ancestor and target element with its merge key value, as
+            # _merge() matches them. ancestor becomes a dict of those
+            # elements; one that is not a keyed list counts as empty.
+            ancestor_items = {}
+            if isinstance(ancestor, list):
+                for item in ancestor:
+                    if (
+                        isinstance(item, dict)
+                        and field in item
+                        and not isinstance(item[field], (dict, list))
+                    ):
+                        ancestor_items.setdefault(item[field], item)
+            target_items = {}
+            for index, item in enumerate(target):
+                target_items.setdefault(item[field], index)
+            items = [(item[field], item) for item in base]
+            base_values = {value for value, _ in items}
+            items.extend(
+                (value, _MISSING)
+                for value in ancestor_items
+                if value not in base_values
+            )
+            # Positions of target elements the site deleted, removed once
+            # the list is done so the positions above stay valid.
+            gone = []
+            return (
+                ancestor_items,
+                base,
+                target,
+                path,
+                state,
+                iter(items),
+                (field, target_items, gone),
+            )
+
+        # A single simultaneous traversal of all three trees on an explicit
+        # stack, visiting the site's keys and then keys only the ancestor
+        # has. Any subtree the site left as it was in the ancestor, or that
+        # already matches the new default, is skipped without being walked.
+        visited = {(id(ancestor), id(base), id(target))}
+        stack = [frame(ancestor, base, target, None, self.skip_rules.root)]
+        while stack:
+            ancestor, base, target, path, state, keys, list_index = stack[-1]
+            if list_index is not None:
+                field, target_items, gone = list_index
+                for value, b in keys:
+                    a = ancestor.get(value, _MISSING)
+                    index = target_items.get(value)
+                    t = _MISSING if index is None else target[index]
+                    if same(b, a, base_digests, ancestor_digests) or same(
+                        b, t, base_digests, target_digests
+                    ):
+                        continue
+                    item_path = KeyPath(path, ListItem(field, value))
+                    if b is not _MISSING and t is not _MISSING:
+                        # Both sides changed the element; list elements do
+                        # not consume a skip rule segment.
+                        triple = (id(a), id(b), id(t))
+                        if triple not in visited:
+                            visited.add(triple)
+                            stack.append(
+                                frame(
+                                    a if isinstance(a, dict) else {},
+                                    b,
+                                    t,
+                                    item_path,
+                                    state,
+                                )
+                            )
+                            break
+                        continue
+                    if same(t, a, target_digests, ancestor_digests):
+                        if b is _MISSING:
+                            gone.append(index)
+                            changes.append(
+                                {"path": item_path, "type": "removed", "old": t}
+                            )
+                        else:
+                            target.append(b)
+                            changes.append(
+                                {"path": item_path, "type": "added", "new": b}
+                            )
+                        continue
+                    conflicts.append(
+                        {
+                            "path": item_path,
+                            "type": "conflict",
+                            "ancestor": None if a is _MISSING else a,
+                            "old": None if t is _MISSING else t,
+                            "new": None if b is _MISSING else b,
+                        }
+                    )
+                    if b is not _MISSING:
+                        target.append(b)
+                else:
+                    for index in sorted(gone, reverse=True):
+                        del target[index]
+                    stack.pop()
+                continue
+            for key in keys:
+                key_state = self.skip_rules.step(state, key)
+                if key_state.skipped:
+                    continue
+                a = ancestor.get(key, _MISSING)
+                b = base.get(key, _MISSING)
+                t = target.get(key, _MISSING)
+                if same(b, a, base_digests, ancestor_digests) or same(
+                    b, t, base_digests, target_digests
+                ):
+                    continue
+                key_path = KeyPath(path, key)
+                if isinstance(b, dict) and isinstance(t, dict):
+                    # Both sides changed the mapping; the ancestor counts as
+                    # empty where it had no mapping here.
+                    triple = (id(a), id(b), id(t))
+                    if triple not in visited:
+                        visited.add(triple)
+                        stack.append(
+                            frame(
+                                a if isinstance(a, dict) else {},
+                                b,
+                                t,
+                                key_path,
+                                key_state,
+                            )
+                        )
+                        break
+                    continue
+                field = self.list_merge_field(b, t)
+                if field is not None:
+                    # Both sides changed a keyed list; only its elements can
+                    # conflict.
+                    triple = (id(a), id(b), id(t))
+                    if triple not in visited:
+                        visited.add(triple)
+                        stack.append(list_frame(a, b, t, key_path, key_state, field))
+                        break
+                    continue
+                if same(t, a, target_digests, ancestor_digests):
+                    if b is _MISSING:
+                        del target[key]
+                        changes.append({"path": key_path, "type": "removed", "old": t})
+                    elif t is _MISSING:
+                        target[key] = b
+                        changes.append({"path": key_path, "type": "added", "new": b})
+                    else:
+                        target[key] = b
+                        changes.append(
+                            {"path": key_path, "type": "updated", "old": t, "new": b}
+                        )
+                    continue
+                conflicts.append(
+                    {
+                        "path": key_path,
+                        "type": "conflict",
+                        "ancestor": None if a is _MISSING else a,
+                        "old": None if t is _MISSING else t,
+                        "new": None if b is _MISSING else b,
+                    }
+                )
+                if b is not _MISSING:
+                    target[key] = b
+            else:
+                stack.pop()
+        return changes, conflicts
 
     def write_merged_yaml(self):
-        self.quote_strings_inplace(self.next_version_data)
         with open(self.merge_output_path, "w") as f:
-            self.yaml.dump(self.next_version_data, f)
+            self.yaml.dump(self.merged_data, f)
+        print(f"Merged YAML written to: {self.merge_output_path}")
+
+    def write_merged_documents(self, documents):
+        with open(self.merge_output_path, "w") as f:
+            for doc in documents:
+                self.yaml.dump(doc, f)
         print(f"Merged YAML written to: {self.merge_output_path}")
 
     def validate_yaml(self):
         try:
             with open(self.merge_output_path, "r") as f:
-                _ = self.yaml.load(f)
+                for _ in self.yaml.load_all(f):
+                    pass
             print(f"Validation: {self.merge_output_path} is a valid YAML file.")
         except Exception as e:
             print(
@@ -149,7 +1922,7 @@ class YamlMerger:
             print(e.stderr)
 
     def helm_validate(self):
-        config_path = "config.json"
+        config_path = CONFIG_PATH
         chart_path = None
         if os.path.exists(config_path):
             try:
@@ -202,56 +1975,449 @@ class YamlMerger:
             )
 
     def write_diff_report(self):
-        def format_value(val):
-            import json as _json
-
-            if isinstance(val, (dict, list)):
-                return _json.dumps(val, ensure_ascii=False)
-            return str(val)
-
         diff_output_path = os.path.join(self.output_dir, "diff.txt")
         with open(diff_output_path, "w") as f:
             for change in self.changes:
-                if change["type"] == "updated":
-                    f.write(
-                        f"{change['path']}: updated | old: {format_value(change['old'])} | new: {format_value(change['new'])}\n"
-                    )
-                elif change["type"] == "added":
+                f.write(_format_change(change) + "\n")
+        print(f"Diff report written to: {diff_output_path}")
+        if self.ancestor_yaml:
+            conflicts_output_path = os.path.join(self.output_dir, "conflicts.txt")
+            with open(conflicts_output_path, "w") as f:
+                for conflict in self.conflicts:
                     f.write(
-                        f"{change['path']}: added | new: {format_value(change['new'])}\n"
+                        f"{conflict['path']}: conflict | ancestor: {_format_value(conflict['ancestor'])} | next: {_format_value(conflict['old'])} | base: {_format_value(conflict['new'])}\n"
                     )
-        print(f"Diff report written to: {diff_output_path}")
+            print(
+                f"{len(self.conflicts)} conflict(s) written to: {conflicts_output_path}"
+            )
 
-    def run(self):
-        self.duplicate_next_version()
-        self.load_yamls()
-        self.changes = self.merge_yaml(self.base_data, self.next_version_data)
-        self.write_merged_yaml()
-        self.validate_yaml()
-        self.kubectl_validate()
+    def result_cache_key(self):
+        # Everything the files and messages of a run depend on: the inputs
+        # and their paths, which overlay attribution reports, the merge
+        # rules and options, the output location, the chart when Helm
+        # validation runs, and the tool itself.
+        inputs = [self.base_yaml, self.next_version_yaml]
+        if self.ancestor_yaml:
+            inputs.append(self.ancestor_yaml)
+        inputs.extend(self.overlays)
+        chart_hash = None
         if self.validate_helm:
-            self.helm_validate()
+            chart_path = _read_config(CONFIG_PATH).get("chart_path")
+            if chart_path and os.path.isdir(chart_path):
+                chart_hash = _tree_hash(chart_path)
+            else:
+                chart_hash = chart_path
+        return DiskCache.make_key(
+            "result",
+            *(file_hash(path) for path in inputs),
+            inputs,
+            self.skip_rules.skip_rules,
+            self.skip_rules.keep_rules,
+            self.list_merge_keys,
+            (
+                len(inputs),
+                self.ancestor_yaml is not None,
+                self.base_is_patch,
+                self.fast,
+                self.stream,
+                self.multi_doc,
+                self.doc_key,
+                self.only_path,
+                self.diff_only,
+                self.report_removed,
+                self.prune,
+                self.validate_helm,
+            ),
+            self.output_dir,
+            self.merge_output_path,
+            chart_hash,
+            _tool_version(),
+        )
+
+    def _result_paths(self):
+        # The files a run in the current mode writes.
+        if self.diff_only:
+            return []
+        paths = []
+        if not (self.fast or self.stream):
+            paths.append(self.merge_output_path)
+        paths.append(os.path.join(self.output_dir, "diff.txt"))
+        if self.ancestor_yaml:
+            paths.append(os.path.join(self.output_dir, "conflicts.txt"))
+        return paths
+
+    def run(self):
+        if self.compile_patch:
+            self.write_patch()
+            return
+        if self.query:
+            self.run_query()
+            return
+        if not self.cache_dir:
+            self._run()
+            return
+        # A previous run on the same inputs, rules and options is replayed:
+        # its output files are restored and its messages, validation
+        # verdicts included, printed again without parsing anything. The
+        # entry holds the contents of the files; where they go comes from
+        # this run's _result_paths(), never from the shared cache.
+        cache = DiskCache(self.cache_dir, self.cache_max_bytes)
+        key = self.result_cache_key()
+        paths = self._result_paths()
+        result = cache.get_tree(key)
+        if result is not None and len(result["files"]) == len(paths):
+            for path, data in zip(paths, result["files"]):
+                with open(path, "wb") as f:
+                    f.write(data)
+            if result["changes"] is not None:
+                self.changes = result["changes"]
+            sys.stdout.write(result["output"])
+            return
+        output = _Tee(sys.stdout)
+        with contextlib.redirect_stdout(output):
+            self._run()
+        files = []
+        for path in paths:
+            with open(path, "rb") as f:
+                files.append(f.read())
+        result = {
+            "files": files,
+            "changes": self.changes if isinstance(self.changes, list) else None,
+            "output": output.buffer.getvalue(),
+        }
+        try:
+            data = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, RecursionError):
+            # Very deep or unpicklable values in the change records; the
+            # files and messages are enough to replay the run.
+            result["changes"] = None
+            data = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+        cache.put(key, data)
+
+    def _run(self):
+        if self.diff_only:
+            self.run_diff_only()
+            return
+        if not (self.overlays or self.base_is_patch) and self.inputs_identical():
+            print("Inputs are identical. Skipping merge and validation.")
+            self.changes = []
+            if not (self.fast or self.stream):
+                shutil.copyfile(self.next_version_yaml, self.merge_output_path)
+                print(f"Merged YAML written to: {self.merge_output_path}")
+            self.write_diff_report()
+            return
+        if self.multi_doc:
+            self.changes = []
+            if self.fast:
+                for _ in self.merge_documents():
+                    pass
+            else:
+                self.write_merged_documents(self.merge_documents())
+        elif self.only_path:
+            self.changes = self.merge_only_path()
+        elif self.stream:
+            self.changes = StreamDiff(
+                self.skip_rules, self.merge_yaml, self.report_removed
+            ).diff(self.base_yaml, self.next_version_yaml)
+        elif self.ancestor_yaml:
+            self.load_yamls()
+            self.changes, self.conflicts = self.merge_three_way(
+                self.ancestor_data, self.base_data, self.next_version_data
+            )
+            self.merged_data = self.next_version_data
+        elif self.overlays:
+            self.load_yamls()
+            self.merged_data, self.changes = self.merge_layered()
+        else:
+            self.load_yamls()
+            fingerprints = self.document_fingerprints(
+                self.base_data,
+                self.next_version_data,
+                (
+                    None if self.base_is_patch else self.base_yaml,
+                    self.next_version_yaml,
+                ),
+            )
+            if _uses_merge_keys(self.next_version_yaml):
+                # Values reached through "<<" are only updated by assigning
+                # to the mapping they are merged into, so merge in place.
+                self.changes = self.merge_yaml(
+                    self.base_data, self.next_version_data, fingerprints=fingerprints
+                )
+                self.merged_data = self.next_version_data
+            elif self.fast:
+                self.changes = self.diff_yaml(
+                    self.base_data, self.next_version_data, fingerprints=fingerprints
+                )
+            else:
+                self.merged_data, self.changes = self.merge_overlay(
+                    self.base_data, self.next_version_data, fingerprints=fingerprints
+                )
+        if self.fast or self.stream:
+            print("Diff-only mode: skipping merged YAML output and validation.")
         else:
-            print("Helm validation not enabled. Skipping Helm validation.")
+            if self.only_path:
+                self.write_only_path_yaml()
+            elif not self.multi_doc:
+                self.write_merged_yaml()
+            self.validate_yaml()
+            self.kubectl_validate()
+            if self.validate_helm:
+                self.helm_validate()
+            else:
+                print("Helm validation not enabled. Skipping Helm validation.")
         self.write_diff_report()
 
+    def merge_layered(self):
+        layers = [(self.base_yaml, self.base_data)]
+        layers.extend(zip(self.overlays, self.overlay_data))
+        fingerprints = None
+        if self.use_fingerprints:
+            fingerprints = self._fingerprints(
+                self.next_version_data, self.next_version_yaml
+            )
+        return self.merge_layers(self.next_version_data, layers, fingerprints)
+
+    def run_query(self):
+        self.load_yamls(index=True)
+        for path, index in (
+            (self.base_yaml, self.base_index),
+            (self.next_version_yaml, self.next_version_index),
+        ):
+            for key_path, value in index.query(self.query):
+                print(f"{path}: {key_path}: {_format_value(value)}")
+
+    def run_diff_only(self):
+        # Change records go to stdout as they are found. Nothing is written
+        # to disk apart from the parse cache when --cache-dir is given.
+        self.changes = _ChangePrinter(sys.stdout)
+        if self.overlays:
+            # A record is only final once every layer has been merged.
+            self.load_yamls()
+            for change in self.merge_layered()[1]:
+                self.changes.append(change)
+            return
+        if not self.base_is_patch and self.inputs_identical():
+            return
+        if self.multi_doc:
+            for _ in self.merge_documents():
+                pass
+        elif self.only_path:
+            self.merge_only_path()
+        elif self.stream:
+            StreamDiff(self.skip_rules, self.diff_yaml, self.report_removed).diff(
+                self.base_yaml, self.next_version_yaml, self.changes
+            )
+        else:
+            self.load_yamls()
+            self.diff_yaml(
+                self.base_data,
+                self.next_version_data,
+                changes=self.changes,
+                fingerprints=self.document_fingerprints(
+                    self.base_data,
+                    self.next_version_data,
+                    (
+                        None if self.base_is_patch else self.base_yaml,
+                        self.next_version_yaml,
+                    ),
+                ),
+            )
+
 
 def main():
     parser = argparse.ArgumentParser(
         description="Merge YAMLs with optional Helm validation."
     )
-    parser.add_argument("base_yaml", help="Base YAML file")
-    parser.add_argument("next_version_yaml", help="Next version YAML file")
+    parser.add_argument(
+        "base_yaml", help="Base YAML file (the next version YAML file with --patch)"
+    )
+    parser.add_argument(
+        "next_version_yaml",
+        nargs="?",
+        help="Next version YAML file (not used with --compile-patch or --patch)",
+    )
     parser.add_argument(
         "--validate-helm",
         action="store_true",
         help="Enable Helm/Kubernetes manifest validation (requires chart path in config.json)",
     )
+    parser.add_argument(
+        "--fast",
+        action="store_true",
+        help="Load with the fast safe (libyaml) loader and only write the diff report; no merged YAML is produced",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Compare the parser event streams of both files with bounded memory and only write the diff report",
+    )
+    parser.add_argument(
+        "--diff-only",
+        action="store_true",
+        help="Only compare the files and print the change records to stdout; nothing is written to disk and no validation runs",
+    )
+    parser.add_argument(
+        "--multi-doc",
+        action="store_true",
+        help="Treat the inputs as multi-document YAML and merge them one document pair at a time (paired by index)",
+    )
+    parser.add_argument(
+        "--doc-key",
+        help="Comma-separated dotted fields identifying a document, e.g. kind,metadata.name; pairs documents by identity and implies --multi-doc",
+    )
+    parser.add_argument(
+        "--only-path",
+        help="Only load and merge this top-level or second-level key path (e.g. global or services.web); the rest of the next-version file is copied verbatim",
+    )
+    parser.add_argument(
+        "--ancestor",
+        help="Previous version of the next-version file; enables a three-way merge in which base holds the site's customised values and conflicts are reported in conflicts.txt",
+    )
+    parser.add_argument(
+        "--parallel-threshold",
+        type=int,
+        help=f"Node count above which top-level subtrees are merged in a process pool; 0 disables it (default: parallel_threshold in config.json, else {DEFAULT_PARALLEL_THRESHOLD})",
+    )
+    parser.add_argument(
+        "--flat-diff-threshold",
+        type=int,
+        help="Node count from which --fast and --diff-only compare with the NumPy flatten-and-sort engine (needs numpy); 0 disables it (default: flat_diff_threshold in config.json, else 0)",
+    )
+    parser.add_argument(
+        "--query",
+        help="Print the values at the key paths matching this pattern (skip rule syntax, e.g. services.*.image.repository) in both files instead of merging",
+    )
+    parser.add_argument(
+        "--removed",
+        action="store_true",
+        help="Also report keys and keyed list elements that only the next version has as removed",
+    )
+    parser.add_argument(
+        "--prune",
+        action="store_true",
+        help="Like --removed, and leave those keys and elements out of the merged YAML",
+    )
+    parser.add_argument(
+        "--overlay",
+        action="append",
+        default=[],
+        metavar="FILE",
+        help="Further values file layered over base_yaml; may be repeated, later files win (like helm -f a -f b)",
+    )
+    parser.add_argument(
+        "--compile-patch",
+        metavar="FILE",
+        help="Parse base_yaml once and write it, with the current skip/keep rules and list merge keys, to FILE; FILE can then be given as base_yaml to merge into any next version without parsing the base again",
+    )
+    parser.add_argument(
+        "--fingerprints",
+        action="store_true",
+        help="Hash every subtree of both files first and skip the subtrees that are equal; cached with --cache-dir",
+    )
+    parser.add_argument(
+        "--patch",
+        metavar="FILE",
+        help="Merge a patch written by --compile-patch instead of a base YAML file; only the next version YAML file is given. Only use patches you compiled yourself",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="Directory for the on-disk cache of parsed files and of whole run results (keyed by content hashes); disabled when omitted",
+    )
+    parser.add_argument(
+        "--cache-max-mb",
+        type=int,
+        default=512,
+        help="Size limit of the cache in MB; least recently used entries are evicted (default: 512)",
+    )
     args = parser.parse_args()
+    if args.patch:
+        if args.next_version_yaml is not None:
+            parser.error("with --patch, only next_version_yaml is given")
+        args.next_version_yaml = args.base_yaml
+        args.base_yaml = args.patch
+    elif args.compile_patch is None and args.next_version_yaml is None:
+        parser.error("next_version_yaml is required unless --compile-patch is given")
+    if args.patch:
+        if (
+            args.compile_patch
+            or args.stream
+            or args.multi_doc
+            or args.doc_key
+            or args.only_path
+            or args.ancestor
+            or args.query
+        ):
+            parser.error(
+                "--patch cannot be combined with --compile-patch, --stream, --only-path, --ancestor, --query or multi-document inputs"
+            )
+    elif args.compile_patch and (args.multi_doc or args.doc_key):
+        parser.error("--compile-patch does not support multi-document inputs")
+    if args.stream and (args.multi_doc or args.doc_key):
+        parser.error("--stream does not support multi-document inputs")
+    if args.ancestor and (
+        args.stream or args.multi_doc or args.doc_key or args.only_path
+    ):
+        parser.error(
+            "--ancestor cannot be combined with --stream, --only-path or multi-document inputs"
+        )
+    if (args.removed or args.prune) and (
+        args.only_path or args.ancestor or args.overlay or args.query
+    ):
+        parser.error(
+            "--removed and --prune cannot be combined with --only-path, --ancestor, --overlay or --query"
+        )
+    if args.overlay and (
+        args.stream
+        or args.multi_doc
+        or args.doc_key
+        or args.only_path
+        or args.ancestor
+        or args.query
+    ):
+        parser.error(
+            "--overlay cannot be combined with --stream, --only-path, --ancestor, --query or multi-document inputs"
+        )
+    if args.query and (
+        args.stream
+        or args.multi_doc
+        or args.doc_key
+        or args.only_path
+        or args.ancestor
+        or args.diff_only
+    ):
+        parser.error("--query cannot be combined with other modes")
+    if args.diff_only and args.ancestor:
+        parser.error("--diff-only cannot be combined with --ancestor")
+    if args.only_path:
+        if args.stream or args.multi_doc or args.doc_key:
+            parser.error(
+                "--only-path cannot be combined with --stream or multi-document inputs"
+            )
+        if len(args.only_path.split(".")) > 2:
+            parser.error("--only-path supports at most two levels (e.g. a.b)")
     merger = YamlMerger(
         base_yaml=args.base_yaml,
         next_version_yaml=args.next_version_yaml,
         validate_helm=args.validate_helm,
+        fast=args.fast,
+        cache_dir=args.cache_dir,
+        cache_max_mb=args.cache_max_mb,
+        stream=args.stream,
+        multi_doc=args.multi_doc,
+        doc_key=args.doc_key.split(",") if args.doc_key else None,
+        only_path=args.only_path,
+        use_fingerprints=args.fingerprints,
+        ancestor_yaml=args.ancestor,
+        parallel_threshold=args.parallel_threshold,
+        diff_only=args.diff_only,
+        flat_diff_threshold=args.flat_diff_threshold,
+        query=args.query,
+        overlays=args.overlay,
+        removed=args.removed,
+        prune=args.prune,
+        compile_patch=args.compile_patch,
+        base_is_patch=bool(args.patch),
     )
     merger.run()
 
@@ -0,0 +1,227 @@
+from bisect import bisect_left
+
+from skip_rules import SkipRules
+
+
+class _Position:
+    # Path segment of a plain list element, rendered as "[0]" right after
+    # the list's own key.
+    __slots__ = ("index",)
+
+    def __init__(self, index):
+        self.index = index
+
+    def __str__(self):
+        return f"[{self.index}]"
+
+
+def _child_path(path, key):
+    # The rendering KeyPath(path, key) would have, from path's rendering
+    # (None at the document root).
+    if isinstance(key, _Position):
+        return (path or "") + str(key)
+    key = str(key).replace("\\", "\\\\").replace(".", "\\.")
+    return key if path is None else f"{path}.{key}"
+
+
+class PathIndex:
+    # Every node of a loaded document by its dotted path, rendered the way
+    # change records render KeyPath ("spec.containers[0].image", dots and
+    # backslashes inside keys escaped). A node shared through aliases has
+    # its subtree indexed once, under the first path that reaches it; its
+    # other paths are indexed as single entries mapped to that first path,
+    # which get() resolves and query() follows. Indexing every path through
+    # the aliases instead grows with the number of paths, not of nodes.
+    #
+    # Entries are kept in document order with the index of their parent and
+    # the end of their subtree, so query() can drop a whole subtree as soon
+    # as its path can no longer match, and prefix() can list a subtree
+    # without searching for it. The row of each path is looked up through a
+    # dict built on the first prefix() call.
+    def __init__(self, root):
+        self.nodes = {}
+        self._paths = []
+        self._values = []
+        self._keys = []
+        self._parents = []
+        self._ends = []
+        self._rows = None
+        # Path and row of every alias entry to the row its node is indexed
+        # at (-1 for the root).
+        self._aliases = {}
+        self._alias_rows = {}
+        if not isinstance(root, (dict, list)):
+            return
+        rows = {id(root): -1}
+        stack = [(self._children(root), None, -1)]
+        while stack:
+            children, path, row = stack[-1]
+            for key, value in children:
+                child_row = len(self._paths)
+                rendered = _child_path(path, key)
+                self.nodes.setdefault(rendered, value)
+                self._paths.append(rendered)
+                self._values.append(value)
+                self._keys.append(key.index if isinstance(key, _Position) else key)
+                self._parents.append(row)
+                self._ends.append(child_row + 1)
+                if isinstance(value, (dict, list)):
+                    first_row = rows.get(id(value))
+                    if first_row is not None:
+                        self._aliases[rendered] = (
+                            "" if first_row < 0 else self._paths[first_row]
+                        )
+                        self._alias_rows[child_row] = first_row
+                        continue
+                    rows[id(value)] = child_row
+                    stack.append((self._children(value), rendered, child_row))
+                    break
+            else:
+                stack.pop()
+                if row >= 0:
+                    self._ends[row] = len(self._paths)
+
+    @staticmethod
+    def _children(node):
+        if isinstance(node, dict):
+            return iter(node.items())
+        return ((_Position(i), value) for i, value in enumerate(node))
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, path):
+        return path in self.nodes
+
+    def _resolve(self, path):
+        # path with its longest aliased prefix replaced by the path the
+        # node is indexed under, repeated until the path is indexed or no
+        # prefix is an alias.
+        while path not in self.nodes:
+            for end in range(len(path), 0, -1):
+                if (end == len(path) or path[end] in ".[") and path[
+                    :end
+                ] in self._aliases:
+                    target = self._aliases[path[:end]]
+                    rest = path[end:]
+                    if not target and rest.startswith("."):
+                        rest = rest[1:]
+                    path = target + rest
+                    break
+            else:
+                return path
+        return path
+
+    def get(self, path, default=None):
+        if path in self.nodes:
+            return self.nodes[path]
+        return self.nodes.get(self._resolve(path), default)
+
+    def prefix(self, path):
+        # (path, node) pairs for path and everything below it, in sorted
+        # path order. Subtrees reached through aliases are listed under
+        # every path that reaches them, as query() lists them.
+        if self._rows is None:
+            self._rows = {}
+            for row, indexed in enumerate(self._paths):
+                self._rows.setdefault(indexed, row)
+        resolved = self._resolve(path)
+        row = self._rows.get(resolved)
+        if row is None:
+            return
+        found = [(path, self._values[row])]
+        # Frames as in query(): the next row, the end row, the prefix paths
+        # are rendered with (indexed path, path through the alias) and the
+        # rows of the aliased subtrees being walked.
+        stack = []
+        if row in self._alias_rows:
+            self._push_alias(stack, row, path, ())
+        else:
+            stack.append([row + 1, self._ends[row], (resolved, path), ()])
+        while stack:
+            frame = stack[-1]
+            row, end, prefix, expanding = frame
+            if row >= end:
+                stack.pop()
+                continue
+            frame[0] = row + 1
+            path = prefix[1] + self._paths[row][len(prefix[0]) :]
+            found.append((path, self._values[row]))
+            if row in self._alias_rows:
+                self._push_alias(stack, row, path, expanding)
+        found.sort(key=lambda item: item[0])
+        yield from found
+
+    def _push_alias(self, stack, row, path, expanding):
+        # Pushes a prefix() frame for the subtree the alias entry at row
+        # refers to, rendered under path, unless the alias refers back to an
+        # ancestor, which would never end.
+        first_row = self._alias_rows[row]
+        if not (
+            first_row < 0
+            or first_row in expanding
+            or first_row < row < self._ends[first_row]
+        ):
+            stack.append(
+                [
+                    first_row + 1,
+                    self._ends[first_row],
+                    (self._paths[first_row], path),
+                    (first_row,) + expanding,
+                ]
+            )
+
+    def query(self, pattern):
+        # (path, node) pairs, in document order, for the paths matching a
+        # pattern in the skip rule syntax: "*" is one key, "**" any number
+        # of keys, other segments are fnmatch patterns or /regular
+        # expressions/. A list element is the segment holding its position,
+        # so "spec.containers.*.image" and "spec.containers.0.image" both
+        # reach "spec.containers[0].image".
+        rules = SkipRules((pattern,))
+        step = rules.step
+        # Each frame walks the rows of one indexed subtree: the next row,
+        # the end row, the state of the subtree's parent, the prefix its
+        # paths are rendered with (indexed path, path through the alias)
+        # and the rows of the aliased subtrees being walked, so an alias
+        # back to one of them is not followed again.
+        stack = [[0, len(self._paths), rules.root, None, (), {}]]
+        while stack:
+            frame = stack[-1]
+            row, end, root_state, prefix, expanding, states = frame
+            if row >= end:
+                stack.pop()
+                continue
+            parent = self._parents[row]
+            state = step(states.get(parent, root_state), self._keys[row])
+            states[row] = state
+            path = self._paths[row]
+            if prefix is not None:
+                path = prefix[1] + path[len(prefix[0]) :]
+            if state.skipped:
+                yield path, self._values[row]
+            frame[0] = self._ends[row]
+            if not state.nodes:
+                continue
+            if row not in self._alias_rows:
+                frame[0] = row + 1
+                continue
+            # An alias back to an ancestor is not followed, as the walk
+            # would never end.
+            first_row = self._alias_rows[row]
+            if (
+                first_row < 0
+                or first_row in expanding
+                or first_row < row < self._ends[first_row]
+            ):
+                continue
+            stack.append(
+                [
+                    first_row + 1,
+                    self._ends[first_row],
+                    state,
+                    (self._paths[first_row], path),
+                    (first_row,) + expanding,
+                    {},
+                ]
+            )
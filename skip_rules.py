@@ -0,0 +1,165 @@
+import fnmatch
+import re
+
+# The keys merge_yaml has always left alone, wherever they appear.
+DEFAULT_SKIP_RULES = (
+    "**.tag",
+    "**.envNFVersion",
+    "**.extraContainersTpl",
+    "**.resources",
+    "**.limits",
+    "**.requests",
+    "**.cpu",
+    "**.memory",
+    "**.ephemeral-storage",
+)
+
+RULE_SEGMENT_RE = re.compile(r"/((?:[^/\\]|\\.)*)/(?:\.|$)|((?:[^.\\]|\\.)+)(?:\.|$)")
+SKIP = "skip"
+KEEP = "keep"
+
+
+class _TrieNode:
+    __slots__ = ("literals", "patterns", "star", "globstar", "loop", "actions")
+
+    def __init__(self, loop=False):
+        self.literals = {}
+        self.patterns = []
+        self.star = None
+        self.globstar = None
+        self.loop = loop
+        self.actions = set()
+
+
+class RuleState:
+    # A set of trie positions reached by one key path. States are interned
+    # and cache their transitions, so after warm-up a key check is a single
+    # dict lookup however many rules there are.
+    __slots__ = ("nodes", "transitions", "skipped")
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.transitions = {}
+        actions = set()
+        for node in nodes:
+            actions |= node.actions
+        self.skipped = SKIP in actions and KEEP not in actions
+
+
+def _split_rule(rule):
+    # Rules are dotted paths. "*" matches one key, "**" any number of keys,
+    # other segments are fnmatch patterns or, between slashes, regular
+    # expressions; "\." is a literal dot inside a key.
+    segments = []
+    pos = 0
+    separated = True
+    while pos < len(rule):
+        match = RULE_SEGMENT_RE.match(rule, pos)
+        if match is None:
+            raise ValueError(f"Invalid path rule: {rule!r}")
+        if match.group(1) is not None:
+            segments.append(re.compile(match.group(1)))
+        else:
+            segments.append(re.sub(r"\\(.)", r"\1", match.group(2)))
+        separated = match.end() > match.end(match.lastindex)
+        pos = match.end()
+    if not segments or separated:
+        raise ValueError(f"Invalid path rule: {rule!r}")
+    return segments
+
+
+class SkipRules:
+    # Skip and keep rules compiled into a trie of path segments that is
+    # matched as a lazily built DFA. A key is skipped when its path matches a
+    # skip rule and no keep rule.
+    def __init__(self, skip_rules=DEFAULT_SKIP_RULES, keep_rules=()):
+        self.skip_rules = tuple(skip_rules)
+        self.keep_rules = tuple(keep_rules)
+        self._trie = _TrieNode()
+        for rule in self.skip_rules:
+            self._add(rule, SKIP)
+        for rule in self.keep_rules:
+            self._add(rule, KEEP)
+        self._states = {}
+        self.root = self._state({self._trie})
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            config.get("skip_rules", DEFAULT_SKIP_RULES),
+            config.get("keep_rules", ()),
+        )
+
+    def _add(self, rule, action):
+        node = self._trie
+        for segment in _split_rule(rule):
+            if segment == "**":
+                if node.globstar is None:
+                    node.globstar = _TrieNode(loop=True)
+                node = node.globstar
+            elif segment == "*":
+                if node.star is None:
+                    node.star = _TrieNode()
+                node = node.star
+            elif isinstance(segment, str) and not any(c in segment for c in "*?["):
+                node = node.literals.setdefault(segment, _TrieNode())
+            else:
+                if isinstance(segment, str):
+                    segment = re.compile(fnmatch.translate(segment))
+                for pattern, child in node.patterns:
+                    if pattern.pattern == segment.pattern:
+                        node = child
+                        break
+                else:
+                    child = _TrieNode()
+                    node.patterns.append((segment, child))
+                    node = child
+        node.actions.add(action)
+
+    def _state(self, nodes):
+        # "**" may match zero keys, so a position before it is also a
+        # position after it.
+        pending = list(nodes)
+        closed = set()
+        while pending:
+            node = pending.pop()
+            if node in closed:
+                continue
+            closed.add(node)
+            if node.globstar is not None:
+                pending.append(node.globstar)
+        closed = frozenset(closed)
+        state = self._states.get(closed)
+        if state is None:
+            state = self._states[closed] = RuleState(closed)
+        return state
+
+    def step(self, state, key):
+        if not state.nodes:
+            return state
+        cache_key = key if type(key) is str else (type(key), key)
+        child = state.transitions.get(cache_key)
+        if child is None:
+            child = state.transitions[cache_key] = self._advance(state, str(key))
+        return child
+
+    def _advance(self, state, segment):
+        nodes = set()
+        for node in state.nodes:
+            if node.loop:
+                nodes.add(node)
+            child = node.literals.get(segment)
+            if child is not None:
+                nodes.add(child)
+            if node.star is not None:
+                nodes.add(node.star)
+            for pattern, child in node.patterns:
+                if pattern.fullmatch(segment):
+                    nodes.add(child)
+        return self._state(nodes)
+
+    def state_for(self, path):
+        state = self.root
+        for key in path:
+            state = self.step(state, key)
+        return state
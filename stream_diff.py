@@ -0,0 +1,189 @@
+from ruamel.yaml import YAML
+from ruamel.yaml.events import (
+    DocumentStartEvent,
+    MappingEndEvent,
+    MappingStartEvent,
+    StreamEndEvent,
+    StreamStartEvent,
+)
+
+from key_path import KeyPath
+
+
+class _EventSide:
+    # One input file read as a parser event stream. Nodes are only composed
+    # and constructed on demand, for keys, scalars and buffered subtrees.
+    def __init__(self, stream):
+        self.yaml = YAML(typ="safe", pure=True)
+        self.constructor, self.parser = self.yaml.get_constructor_parser(stream)
+        self.composer = self.yaml.composer
+
+    def check(self, event_type):
+        return self.parser.check_event(event_type)
+
+    def next_event(self):
+        return self.parser.get_event()
+
+    def compose(self):
+        return self.composer.compose_node(None, None)
+
+    def build(self):
+        return self.constructor.construct_document(self.compose())
+
+    def skip(self):
+        # Composed rather than dropped event by event so anchors defined in
+        # the skipped subtree stay resolvable for later aliases.
+        self.compose()
+
+    def streamable(self):
+        # Anchored mappings are composed so aliases can refer to them later;
+        # tagged mappings need their constructor.
+        event = self.parser.peek_event()
+        return (
+            isinstance(event, MappingStartEvent)
+            and event.anchor is None
+            and event.ctag is None
+        )
+
+    def close(self):
+        self.parser.dispose()
+
+
+def _uses_merge_keys(path, chunk_size=1 << 20):
+    # Merge keys ("<<: *anchor") splice mappings together at construction
+    # time, which a one-pass event walk cannot reproduce.
+    tail = b""
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return False
+            if b"<<" in tail + chunk:
+                return True
+            tail = chunk[-1:]
+
+
+class StreamDiff:
+    # Compares two YAML files by walking both parser event streams at the
+    # same time. Matching keys are descended into without building either
+    # subtree; a subtree is only materialised when the two sides diverge
+    # (keys in a different order, a value to report, or non-mapping values),
+    # and then handed to merge_fn so the change records match merge_yaml.
+    # With report_removed, keys only the target has are reported as removed
+    # at the end of their mapping, as merge_yaml does.
+    def __init__(self, skip_rules, merge_fn, report_removed=False):
+        self.skip_rules = skip_rules
+        self.merge_fn = merge_fn
+        self.report_removed = report_removed
+
+    def diff(self, base_path, target_path, changes=None):
+        if changes is None:
+            changes = []
+        if _uses_merge_keys(base_path) or _uses_merge_keys(target_path):
+            loader = YAML(typ="safe")
+            with open(base_path, "r") as f:
+                base_data = loader.load(f)
+            with open(target_path, "r") as f:
+                target_data = loader.load(f)
+            return self.merge_fn(base_data, target_data, None, changes)
+        with open(base_path, "r") as base_stream, open(
+            target_path, "r"
+        ) as target_stream:
+            base = _EventSide(base_stream)
+            target = _EventSide(target_stream)
+            try:
+                for side in (base, target):
+                    if side.check(StreamStartEvent):
+                        side.next_event()
+                    if side.check(DocumentStartEvent):
+                        side.next_event()
+                if base.streamable() and target.streamable():
+                    self._diff_mappings(
+                        base, target, None, self.skip_rules.root, changes
+                    )
+                else:
+                    self.merge_fn(self._build(base), self._build(target), None, changes)
+            finally:
+                base.close()
+                target.close()
+        return changes
+
+    @staticmethod
+    def _build(side):
+        if side.check(StreamEndEvent):
+            return None
+        return side.build()
+
+    def _diff_mappings(self, base, target, path, state, changes):
+        base.next_event()
+        target.next_event()
+        pending = {}
+        target_open = True
+        while not base.check(MappingEndEvent):
+            key = base.build()
+            key_state = self.skip_rules.step(state, key)
+            if key_state.skipped:
+                base.skip()
+                continue
+            current_path = KeyPath(path, key)
+            if key in pending:
+                self._diff_values(
+                    base.build(), pending.pop(key), path, key, state, changes
+                )
+                continue
+            found = False
+            while target_open:
+                if target.check(MappingEndEvent):
+                    target.next_event()
+                    target_open = False
+                    break
+                target_key = target.build()
+                if target_key == key:
+                    found = True
+                    break
+                if self.skip_rules.step(state, target_key).skipped:
+                    target.skip()
+                else:
+                    pending[target_key] = target.build()
+            if not found:
+                changes.append(
+                    {
+                        "path": current_path,
+                        "type": "added",
+                        "new": base.build(),
+                    }
+                )
+            elif base.streamable() and target.streamable():
+                self._diff_mappings(base, target, current_path, key_state, changes)
+            else:
+                self._diff_values(
+                    base.build(), target.build(), path, key, state, changes
+                )
+        base.next_event()
+        if self.report_removed:
+            for key, value in pending.items():
+                changes.append(
+                    {"path": KeyPath(path, key), "type": "removed", "old": value}
+                )
+        while target_open:
+            if target.check(MappingEndEvent):
+                target.next_event()
+                break
+            if not self.report_removed:
+                target.skip()
+                target.skip()
+                continue
+            key = target.build()
+            if self.skip_rules.step(state, key).skipped:
+                target.skip()
+                continue
+            changes.append(
+                {"path": KeyPath(path, key), "type": "removed", "old": target.build()}
+            )
+
+    def _diff_values(self, base_value, target_value, path, key, state, changes):
+        # Single-key mappings give merge_fn the pair under its own key, so
+        # the comparison is exactly the one merge_yaml makes.
+        self.merge_fn(
+            {key: base_value}, {key: target_value}, path, changes, state=state
+        )
@@ -0,0 +1,428 @@
+import io
+import os
+import pickle
+
+import pytest
+from ruamel.yaml import YAML
+
+import merge_yamls
+from merge_yamls import YamlMerger, _format_change, _index_keys
+from path_index import PathIndex
+
+
+@pytest.fixture
+def make_merger(tmp_path, monkeypatch):
+    # Mergers run in a scratch directory, so they use the default rules
+    # instead of the repository's config.json. Tests that load the files
+    # they are named after write them first.
+    monkeypatch.chdir(tmp_path)
+
+    def make(**kwargs):
+        kwargs.setdefault("parallel_threshold", 0)
+        return YamlMerger("base.yml", "next.yml", **kwargs)
+
+    return make
+
+
+def _load(text):
+    return YAML().load(text)
+
+
+def _dump(data):
+    stream = io.StringIO()
+    YAML().dump(data, stream)
+    return stream.getvalue()
+
+
+def _lines(changes):
+    return [_format_change(change) for change in changes]
+
+
+def _merge_all_ways(merger, base_text, target_text):
+    # (merged YAML, change lines) from merge_yaml, merge_overlay and
+    # diff_yaml, checking that the copy-on-write walks leave their inputs
+    # alone.
+    base, target = _load(base_text), _load(target_text)
+    in_place = _lines(merger.merge_yaml(base, target))
+    in_place_yaml = _dump(target)
+
+    base, target = _load(base_text), _load(target_text)
+    merged, changes = merger.merge_overlay(base, target)
+    overlay = _lines(changes)
+    overlay_yaml = _dump(merged)
+    assert _dump(target) == _dump(_load(target_text))
+    assert _dump(base) == _dump(_load(base_text))
+
+    base, target = _load(base_text), _load(target_text)
+    diff = _lines(merger.diff_yaml(base, target))
+    assert _dump(target) == _dump(_load(target_text))
+
+    assert in_place == overlay == diff
+    assert in_place_yaml == overlay_yaml
+    return overlay_yaml, overlay
+
+
+CASES = {
+    "nested": (
+        "a: {x: 1, y: {z: 2}}\nb: [1, 2]\nc: new\n",
+        "a: {x: 0, y: {z: 2, w: 3}}\nb: [1]\n",
+    ),
+    "skipped keys": (
+        "image: {tag: v2, repository: r2}\nresources: {cpu: 2}\n",
+        "image: {tag: v1, repository: r1}\nresources: {cpu: 1}\n",
+    ),
+    "alias merged twice": (
+        "a: {x: 1}\nb: {x: 2}\n",
+        "a: &s {x: 2}\nb: *s\n",
+    ),
+    "alias below siblings": (
+        "a: {s: {x: 1}}\nb: {s: {x: 2}}\n",
+        "a: {s: &s {x: 2}}\nb: {s: *s}\n",
+    ),
+    "alias in base": (
+        "a: &s {x: 1, y: [1]}\nb: *s\n",
+        "a: {x: 0}\nb: {x: 0, y: [2]}\n",
+    ),
+    "keyed list": (
+        "l: [{name: a, v: 1}, {name: c, v: 3}]\n",
+        "l: [{name: a, v: 0}, {name: b, v: 2}]\n",
+    ),
+    "repeated list merge key": (
+        "l: [{name: a, v: 1}, {name: a, v: 2}]\n",
+        "l: [{name: a, v: 0}]\n",
+    ),
+    "repeated key in target": (
+        "l: [{name: a, v: {k: 1}}]\n",
+        "l: [{name: a, v: {k: 0}}, {name: a, v: {k: 2}}]\n",
+    ),
+}
+
+
+@pytest.mark.parametrize("name", sorted(CASES))
+def test_merge_functions_agree(make_merger, name):
+    base_text, target_text = CASES[name]
+    _merge_all_ways(make_merger(), base_text, target_text)
+
+
+def test_alias_stays_shared(make_merger):
+    merged, changes = _merge_all_ways(make_merger(), *CASES["alias merged twice"])
+    assert merged == "a: &s {x: 2}\nb: *s\n"
+    assert changes == [
+        "a.x: updated | old: 2 | new: 1",
+        "b.x: updated | old: 1 | new: 2",
+    ]
+
+
+def test_repeated_list_merge_key(make_merger):
+    merged, changes = _merge_all_ways(make_merger(), *CASES["repeated list merge key"])
+    assert merged == "l: [{name: a, v: 2}]\n"
+    assert changes == [
+        "l[name=a].v: updated | old: 0 | new: 1",
+        "l[name=a].v: updated | old: 1 | new: 2",
+    ]
+
+
+@pytest.mark.parametrize("prune", [False, True])
+def test_removed_keys(make_merger, prune):
+    base_text = "a: {x: 1}\nl: [{name: a, v: 1}]\n"
+    target_text = "a: {x: 1, y: 2}\nl: [{name: a, v: 1}, {name: b, v: 2}]\nz: 3\n"
+    merged, changes = _merge_all_ways(
+        make_merger(removed=True, prune=prune), base_text, target_text
+    )
+    assert changes == [
+        "a.y: removed | old: 2",
+        'l[name=b]: removed | old: {"name": "b", "v": 2}',
+        "z: removed | old: 3",
+    ]
+    if prune:
+        assert merged == "a: {x: 1}\nl: [{name: a, v: 1}]\n"
+    else:
+        assert merged == _dump(_load(target_text))
+
+
+@pytest.mark.parametrize("name", sorted(CASES))
+def test_fingerprints_change_nothing(make_merger, name):
+    base_text, target_text = CASES[name]
+    expected = _merge_all_ways(make_merger(), base_text, target_text)
+    merger = make_merger(use_fingerprints=True)
+    base, target = _load(base_text), _load(target_text)
+    fingerprints = merger.document_fingerprints(base, target)
+    merged, changes = merger.merge_overlay(base, target, fingerprints)
+    assert (_dump(merged), _lines(changes)) == expected
+
+
+@pytest.mark.parametrize("removed", [False, True])
+def test_parallel_merge_matches_serial(make_merger, monkeypatch, removed):
+    base_text = "".join(
+        f"s{i}: {{image: {{repository: r{i}}}, ports: [{{name: http, port: {i}}}]}}\n"
+        for i in range(8)
+    )
+    target_text = "".join(
+        f"s{i}: {{image: {{repository: r}}, ports: [{{name: http, port: 1}}], x: {i}}}\n"
+        for i in range(0, 10, 2)
+    )
+    serial = _merge_all_ways(
+        make_merger(removed=removed, prune=removed), base_text, target_text
+    )
+    monkeypatch.setattr(merge_yamls.os, "cpu_count", lambda: 4)
+    merger = make_merger(parallel_threshold=1, removed=removed, prune=removed)
+    assert (
+        merger._merge_parallel(_load(base_text), _load(target_text), [], None, True)
+        is not None
+    )
+    assert _merge_all_ways(merger, base_text, target_text) == serial
+
+
+def test_layers_report_against_target(make_merger):
+    merger = make_merger()
+    target = _load("a: 0\nn: {p: 1}\nl: [{name: x, v: 1}]\n")
+    layers = [
+        ("one.yml", _load("a: 1\nm: {q: 1}\nl: [{name: y, v: 2}]\n")),
+        ("two.yml", _load("a: 2\nm: {q: 2}\nl: [{name: x, v: 3}]\n")),
+    ]
+    merged, changes = merger.merge_layers(target, layers)
+    assert _dump(merged) == (
+        "a: 2\nn: {p: 1}\nl: [{name: x, v: 3}, {name: y, v: 2}]\nm: {q: 2}\n"
+    )
+    assert _lines(changes) == [
+        "a: updated | old: 0 | new: 2 | from: two.yml",
+        'm: added | new: {"q": 2} | from: one.yml, two.yml',
+        'l[name=y]: added | new: {"name": "y", "v": 2} | from: one.yml',
+        "l[name=x].v: updated | old: 1 | new: 3 | from: two.yml",
+    ]
+    assert _dump(target) == "a: 0\nn: {p: 1}\nl: [{name: x, v: 1}]\n"
+
+
+def test_layers_match_consecutive_merges(make_merger):
+    merger = make_merger()
+    texts = [
+        "a: {x: 1}\nl: [{name: x, v: 1}]\nk: &k {z: 1}\nj: *k\n",
+        "a: 5\nl: [{name: x, v: {w: 1}}]\n",
+        "a: {y: 2}\nl: [{name: z, v: 2}]\nk: {z: 2}\n",
+    ]
+    target = _load("a: {x: 0}\nl: [{name: x, v: 0}]\nk: {z: 0}\nj: {z: 0}\n")
+    expected = target
+    for text in texts:
+        expected, _ = merger.merge_overlay(_load(text), expected)
+    layers = [(f"{index}.yml", _load(text)) for index, text in enumerate(texts)]
+    merged, _ = merger.merge_layers(target, layers)
+    assert _dump(merged) == _dump(expected)
+
+
+# The same document with svc.env written as a block sequence at and below
+# its key's indentation, and as a one-line and a multi-line flow sequence.
+INDENTLESS = (
+    b'svc:\n  env:\n  - name: A\n    value: "1"\n  # note\n  port: 80\ntop: 1\n'
+)
+INDENTED = b'svc:\n  env:\n    - name: A\n      value: "1"\n  port: 80\ntop: 1\n'
+FLOW = b'svc:\n  env: [{name: A, value: "1"}]\n  port: 80\ntop: 1\n'
+FLOW_LINES = b'svc:\n  env: [\n    {name: A, value: "1"}\n  ]\n  port: 80\ntop: 1\n'
+LIST_STYLES = [INDENTLESS, INDENTED, FLOW, FLOW_LINES]
+LIST_STYLE_IDS = ["indentless", "indented", "flow", "flow lines"]
+
+
+@pytest.mark.parametrize("data", LIST_STYLES, ids=LIST_STYLE_IDS)
+def test_index_keys(data):
+    top = _index_keys(data, 0, len(data), 0)
+    assert list(top) == ["svc", "top"]
+    body = data.index(b"\n") + 1
+    assert top["svc"] == (0, data.index(b"top:"), 0)
+    children = _index_keys(data, body, top["svc"][1])
+    env_start, env_end, indent = children["env"]
+    assert indent == 2
+    assert data[env_start:env_end].startswith(b"  env:")
+    assert env_end == data.index(b"  port:")
+    assert children["port"][:2] == (env_end, top["svc"][1])
+
+
+def test_index_keys_sequence_at_top_level():
+    data = b"env:\n- name: A\n-\n  name: B\nx: 1\n"
+    assert _index_keys(data, 0, len(data), 0) == {
+        "env": (0, data.index(b"x:"), 0),
+        "x": (data.index(b"x:"), len(data), 0),
+    }
+
+
+@pytest.mark.parametrize("data", LIST_STYLES, ids=LIST_STYLE_IDS)
+def test_only_path_merge(make_merger, tmp_path, data):
+    (tmp_path / "base.yml").write_bytes(
+        b'svc:\n  env:\n  - name: A\n    value: "0"\n  port: 81\n'
+    )
+    (tmp_path / "next.yml").write_bytes(data)
+    merger = make_merger(only_path="svc.env")
+    location = merger._locate_only_path(data)
+    assert location[:3] == (data.index(b"  env:"), data.index(b"  port:"), 2)
+    assert location[3] == b"svc:\n"
+    changes = merger.merge_only_path()
+    assert _lines(changes) == ["svc.env[name=A].value: updated | old: 1 | new: 0"]
+    merger.write_only_path_yaml()
+    written = (tmp_path / "output" / "next_merge.yaml").read_bytes()
+    assert written.startswith(b"svc:\n  env:")
+    assert written.endswith(b"  port: 80\ntop: 1\n")
+    assert _load(written.decode("utf-8")) == _load(
+        'svc:\n  env: [{name: A, value: "0"}]\n  port: 80\ntop: 1\n'
+    )
+
+
+def test_only_path_sequence_at_top_level(make_merger, tmp_path):
+    (tmp_path / "base.yml").write_bytes(b"env: {}\n")
+    (tmp_path / "next.yml").write_bytes(b'env:\n- name: A\n  value: "1"\nx: 1\n')
+    merger = make_merger(only_path="env")
+    changes = merger.merge_only_path()
+    assert _lines(changes) == [
+        'env: updated | old: [{"name": "A", "value": "1"}] | new: {}'
+    ]
+    merger.write_only_path_yaml()
+    assert (tmp_path / "output" / "next_merge.yaml").read_bytes() == b"env: {}\nx: 1\n"
+
+
+def test_result_cache_replays_only_matching_paths(make_merger, tmp_path, capsys):
+    (tmp_path / "base.yml").write_text("a: 1\nb: 1\n")
+    (tmp_path / "next.yml").write_text("a: 2\nb: 2\n")
+    for name in ("ov.yml", "hotfix.yml"):
+        (tmp_path / name).write_text("b: 3\n")
+    for overlay in ("ov.yml", "hotfix.yml", "hotfix.yml"):
+        make_merger(diff_only=True, overlays=[overlay], cache_dir="cache").run()
+        assert capsys.readouterr().out.splitlines() == [
+            "a: updated | old: 2 | new: 1 | from: base.yml",
+            f"b: updated | old: 2 | new: 3 | from: {overlay}",
+        ]
+
+
+def test_result_cache_refuses_other_globals(make_merger, tmp_path, capsys):
+    # An entry that would call a function when unpickled is run again
+    # instead of replayed.
+    (tmp_path / "base.yml").write_text("a: 1\n")
+    (tmp_path / "next.yml").write_text("{}\n")
+    merger = make_merger(diff_only=True, cache_dir="cache")
+    (tmp_path / "cache").mkdir()
+    entry = {"files": [], "changes": [os.getcwd], "output": "replayed\n"}
+    (tmp_path / "cache" / (merger.result_cache_key() + ".bin")).write_bytes(
+        pickle.dumps(entry)
+    )
+    merger.run()
+    assert capsys.readouterr().out == "a: added | new: 1\n"
+
+
+def test_inputs_identical_with_application_tags(make_merger, tmp_path):
+    # The safe loader cannot load !Ref, so the files are merged instead of
+    # being compared by their semantic hash.
+    (tmp_path / "base.yml").write_text("a: !Ref foo\n")
+    (tmp_path / "next.yml").write_text("a:   !Ref foo  # same\n")
+    for _ in range(2):
+        assert not make_merger(cache_dir="cache").inputs_identical()
+    (tmp_path / "base.yml").write_text("a: 1\n")
+    (tmp_path / "next.yml").write_text("a:   1  # same\n")
+    assert make_merger(cache_dir="cache").inputs_identical()
+
+
+def _three_way(merger, ancestor_text, base_text, target_text):
+    target = _load(target_text)
+    changes, conflicts = merger.merge_three_way(
+        _load(ancestor_text), _load(base_text), target
+    )
+    return _dump(target), _lines(changes), [str(c["path"]) for c in conflicts]
+
+
+def test_three_way_keyed_list_keeps_both_sides(make_merger):
+    assert _three_way(
+        make_merger(),
+        "env: [{name: A, value: 1}]\n",
+        "env: [{name: A, value: 1}, {name: C, value: 3}]\n",
+        "env: [{name: A, value: 1}, {name: B, value: 2}]\n",
+    ) == (
+        "env: [{name: A, value: 1}, {name: B, value: 2}, {name: C, value: 3}]\n",
+        ['env[name=C]: added | new: {"name": "C", "value": 3}'],
+        [],
+    )
+
+
+def test_three_way_keyed_list_element_conflicts(make_merger):
+    assert _three_way(
+        make_merger(),
+        "env: [{name: A, value: 1}, {name: D, value: 4}, {name: E, value: 5}]\n",
+        "env: [{name: A, value: 7}, {name: E, value: 5}]\n",
+        "env: [{name: A, value: 8}, {name: D, value: 4}, {name: E, value: 9}]\n",
+    ) == (
+        "env: [{name: A, value: 7}, {name: E, value: 9}]\n",
+        ['env[name=D]: removed | old: {"name": "D", "value": 4}'],
+        ["env[name=A].value"],
+    )
+
+
+@pytest.mark.parametrize("cpus", [1, 4])
+def test_small_inputs_parse_without_pool(make_merger, tmp_path, monkeypatch, cpus):
+    def no_pool(*args, **kwargs):
+        raise AssertionError("process pool started")
+
+    monkeypatch.setattr(merge_yamls.os, "cpu_count", lambda: cpus)
+    monkeypatch.setattr(merge_yamls, "ProcessPoolExecutor", no_pool)
+    (tmp_path / "base.yml").write_text("a: 1\n")
+    (tmp_path / "next.yml").write_text("{}\n")
+    merger = make_merger()
+    merger.load_yamls()
+    assert (merger.base_data, merger.next_version_data) == ({"a": 1}, {})
+
+
+def test_parse_cache_refuses_other_globals(tmp_path):
+    # An entry that would call a function when unpickled is parsed again.
+    path = tmp_path / "values.yml"
+    path.write_text("a: 1\n")
+    key = merge_yamls.DiskCache.make_key(
+        "parse",
+        merge_yamls.content_hash(path.read_bytes()),
+        merge_yamls.ruamel.yaml.__version__,
+        False,
+    )
+    cache = merge_yamls.DiskCache(str(tmp_path / "cache"))
+    cache.put(key, pickle.dumps(os.getcwd))
+    data = merge_yamls._load_yaml_file(
+        str(path), False, cache.cache_dir, cache.max_bytes
+    )
+    assert data == {"a": 1}
+    assert cache.get_tree(key) == {"a": 1}
+
+
+def test_layers_with_merge_keys(make_merger):
+    # A "<<" merge key in the target or a layer merges in place, without
+    # looking at any file.
+    merger = make_merger()
+    target = _load("d: &d {x: 1}\na:\n  <<: *d\n  y: 1\n")
+    layers = [("one.yml", _load("a: {x: 2}\n")), ("two.yml", _load("b: 1\n"))]
+    merged, changes = merger.merge_layers(target, layers)
+    assert merged is target
+    assert merged["a"]["x"] == 2 and merged["d"]["x"] == 1
+    assert _lines(changes) == [
+        "a.x: updated | old: 1 | new: 2 | from: one.yml",
+        "b: added | new: 1 | from: two.yml",
+    ]
+    target = _load("a: {x: 1}\n")
+    layers = [("one.yml", _load("d: &d {x: 2}\na:\n  <<: *d\n"))]
+    merged, changes = merger.merge_layers(target, layers)
+    assert merged is target
+
+
+def test_path_index_prefix_follows_aliases():
+    index = PathIndex(
+        _load(
+            "defaults: &d {image: {repository: r}, port: 1}\n"
+            "services:\n  a: *d\n  b: {port: 2}\n  c: *d\n"
+        )
+    )
+    assert [path for path, _ in index.prefix("services")] == [
+        "services",
+        "services.a",
+        "services.a.image",
+        "services.a.image.repository",
+        "services.a.port",
+        "services.b",
+        "services.b.port",
+        "services.c",
+        "services.c.image",
+        "services.c.image.repository",
+        "services.c.port",
+    ]
+    assert list(index.prefix("services.c.image")) == [
+        ("services.c.image", index.get("defaults.image")),
+        ("services.c.image.repository", "r"),
+    ]
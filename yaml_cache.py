@@ -0,0 +1,159 @@
+import contextlib
+import hashlib
+import io
+import os
+import pickle
+import tempfile
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_hash(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# The modules whose classes a loaded document, and the change records and
+# fingerprints built from one, are made of. Pickles read back from a cache
+# directory or a compiled patch may only refer to classes from these, so
+# loading one cannot call anything else (os.system, eval, ...) the way an
+# arbitrary pickle can.
+_TREE_MODULES = frozenset(
+    (
+        "ruamel.yaml.anchor",
+        "ruamel.yaml.comments",
+        "ruamel.yaml.error",
+        "ruamel.yaml.mergevalue",
+        "ruamel.yaml.scalarbool",
+        "ruamel.yaml.scalarfloat",
+        "ruamel.yaml.scalarint",
+        "ruamel.yaml.scalarstring",
+        "ruamel.yaml.tag",
+        "ruamel.yaml.timestamp",
+        "ruamel.yaml.tokens",
+    )
+)
+_TREE_GLOBALS = frozenset(
+    (
+        ("builtins", "set"),
+        ("builtins", "frozenset"),
+        ("collections", "OrderedDict"),
+        ("datetime", "date"),
+        ("datetime", "datetime"),
+        ("datetime", "timedelta"),
+        ("datetime", "timezone"),
+        ("key_path", "KeyPath"),
+        ("key_path", "ListItem"),
+    )
+)
+
+
+class TreeUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if module in _TREE_MODULES or (module, name) in _TREE_GLOBALS:
+            value = super().find_class(module, name)
+            if isinstance(value, type):
+                return value
+        raise pickle.UnpicklingError(f"{module}.{name} is not allowed in a YAML tree")
+
+
+def loads_tree(data):
+    return TreeUnpickler(io.BytesIO(data)).load()
+
+
+# Size-bounded LRU cache of byte blobs stored as files in one directory.
+# Writes go through a temporary file and os.replace() so readers never see
+# partial entries, and an flock() on a lock file serialises eviction so
+# several processes can share the same directory.
+class DiskCache:
+    def __init__(self, cache_dir, max_bytes=512 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.lock_path = os.path.join(self.cache_dir, ".lock")
+
+    @staticmethod
+    def make_key(*parts):
+        return content_hash("\0".join(str(p) for p in parts).encode("utf-8"))
+
+    @contextlib.contextmanager
+    def _locked(self, exclusive):
+        with open(self.lock_path, "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key + ".bin")
+
+    def get(self, key):
+        path = self._entry_path(key)
+        with self._locked(exclusive=False):
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                return None
+            # Bump the mtime so eviction treats this entry as recently used.
+            with contextlib.suppress(OSError):
+                os.utime(path)
+        return data
+
+    def get_tree(self, key):
+        # get() for an entry written with pickle, read back through
+        # TreeUnpickler. An entry that refers to any other global is
+        # treated as missing.
+        data = self.get(key)
+        if data is None:
+            return None
+        try:
+            return loads_tree(data)
+        except pickle.UnpicklingError:
+            return None
+
+    def put(self, key, data):
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            with self._locked(exclusive=True):
+                os.replace(tmp_path, self._entry_path(key))
+                self._evict()
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp_path)
+            raise
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith(".bin"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            with contextlib.suppress(OSError):
+                os.unlink(path)
+            total -= size